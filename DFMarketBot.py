@@ -1,10 +1,15 @@
+import argparse
 import sys
-import gc  # 添加垃圾回收模块
+import threading
+import time
 from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.QtCore import QObject, pyqtSignal, Qt, QThread
+from PyQt5.QtCore import QObject, pyqtSignal, Qt, QThread, QTimer
 from GUI.AppGUI import Ui_MainWindow
 from backend.BuyBot import BuyBot
+from backend.BotLoop import BotLoop
 from backend.utils import *
+from backend.http_control import start_http_control
+from backend.ledger import SpendLedger
 import keyboard
 
 
@@ -24,157 +29,93 @@ class KeyMonitor(QObject):
             print("停止循环")
 
 
+class OcrLoader(QThread):
+    """在后台加载并预热OCR模型，避免阻塞窗口显示"""
+
+    ready = pyqtSignal(bool, str)
+
+    def __init__(self, buybot):
+        super().__init__()
+        self.buybot = buybot
+
+    def run(self):
+        try:
+            # 首次运行时的截图方法基准测试也放在后台
+            self.buybot.select_screenshot_method()
+            self.buybot.load_ocr()
+            self.buybot.warm_up()
+            self.ready.emit(True, "OCR就绪，按 F8 开始")
+        except Exception as e:
+            print(f"OCR加载失败: {e}")
+            self.ready.emit(False, f"OCR加载失败: {e}")
+
+
 class Worker(QThread):
-    update_signal = pyqtSignal(int)
+    update_signal = pyqtSignal(object)  # 价格，识别失败时为None
     param_update = pyqtSignal(int)  # 新增参数更新信号
 
-    def __init__(self, buybot):
+    # 两次界面刷新之间的最小间隔（秒），限制跨线程事件的频率
+    UPDATE_INTERVAL = 0.2
+
+    def __init__(self, buybot, ledger=None, on_limit="stop"):
         super().__init__()
         self.buybot = buybot
-        self._is_running = False
-        self.lock = QtCore.QMutex()
-        self.ideal_price = 0
-        self.unacceptable_price = 0
-        self.loop_gap = 0
-        self.is_convertible = True
-        self.is_key_mode = False
-        self.mouse_position = []
-        self.mouse_position_lock = QtCore.QMutex()
-        self.param_lock = QtCore.QMutex()  # 参数专用锁
+        # 决策循环与界面无关，放在BotLoop中，无界面模式也复用它
+        self.loop = BotLoop(
+            buybot, on_price=self.handle_price, ledger=ledger, on_limit=on_limit
+        )
+        self._emitted_price = None
+        self._pending_price = None
+        self._has_pending = False
+        self._last_emit = 0.0
+        self._lock = threading.Lock()
+        # 在主线程中定时补发限速期间暂存的价格，循环停止后界面也能显示最新值
+        self._flush_timer = QTimer()
+        self._flush_timer.timeout.connect(self.flush_pending)
+        self._flush_timer.start(int(self.UPDATE_INTERVAL * 1000))
+
+    def handle_price(self, price):
+        """
+        合并价格更新：只在价格变化时发信号，且频率不超过UPDATE_INTERVAL
+        限速期间的变化先暂存，由下一次循环或主线程的定时器补发最新值
+        """
+        with self._lock:
+            if price != self._emitted_price:
+                self._pending_price = price
+                self._has_pending = True
+        self.flush_pending()
+
+    def flush_pending(self):
+        """距上次发信号已超过UPDATE_INTERVAL时发出暂存的价格"""
+        with self._lock:
+            if not self._has_pending:
+                return
+            now = time.perf_counter()
+            if now - self._last_emit < self.UPDATE_INTERVAL:
+                return
+            self._emitted_price = self._pending_price
+            self._has_pending = False
+            self._last_emit = now
+            price = self._emitted_price
+        self.update_signal.emit(price)
 
     def record_mouse_position(self):
         """记录鼠标位置"""
-        self.mouse_position_lock.lock()
-        self.mouse_position = get_mouse_position()
-        self.mouse_position_lock.unlock()
+        self.loop.record_mouse_position()
 
     def run(self):
-        # 添加状态变量，跟踪是否在商品页面
-        in_product_page = False
-
-        while True:
-            # 获取运行状态
-            self.lock.lock()
-            running = self._is_running
-            self.lock.unlock()
-
-            if running:
-                try:
-                    # 获取当前参数值
-                    self.param_lock.lock()
-                    current_ideal = self.ideal_price
-                    current_unacceptable = self.unacceptable_price
-                    current_convertible = self.is_convertible
-                    current_key_mode = self.is_key_mode
-                    self.param_lock.unlock()
-
-                    # 仅在需要时进入商品页面
-                    if not in_product_page:
-                        mouse_click(self.mouse_position, num=1)
-                        in_product_page = True
-
-                    # 检测逻辑
-                    lowest_price = self.buybot.detect_price(
-                        is_convertible=current_convertible, debug_mode=False
-                    )
-                    self.update_signal.emit(lowest_price)
-
-                    # # 在价格比较前添加None检查（有问题暂时注释掉）
-                    # if lowest_price is None:
-                    #     print("OCR识别失败，跳过本次循环")
-                    #     continue  # 跳过本次循环，继续下一次
-
-                    if current_key_mode:
-                        # 钥匙卡模式
-                        if lowest_price > current_ideal:
-                            print(
-                                "当前价格：",
-                                lowest_price,
-                                "高于理想价格",
-                                current_ideal,
-                                "，免费刷新价格",
-                            )
-                            self.buybot.freerefresh(good_postion=self.mouse_position)
-                            # 已经重新进入商品页面，保持in_product_page=True
-                        else:
-                            print(
-                                "当前价格：",
-                                lowest_price,
-                                "低于理想价格",
-                                current_ideal,
-                                "，购买一张后循环结束",
-                            )
-                            self.buybot.refresh(is_convertible=False)
-                            self.set_running(False)
-                            print("停止循环")
-                            in_product_page = False  # 循环停止，重置状态
-                    else:
-                        # 正常模式
-                        if lowest_price > current_unacceptable:
-                            print(
-                                "当前价格：",
-                                lowest_price,
-                                "高于最高价格",
-                                current_unacceptable,
-                                "，免费刷新价格",
-                            )
-                            self.buybot.freerefresh(good_postion=self.mouse_position)
-                            # 已经重新进入商品页面，保持in_product_page=True
-                        elif (
-                            lowest_price <= current_unacceptable
-                            and lowest_price > current_ideal
-                        ):
-                            print(
-                                "当前价格：",
-                                lowest_price,
-                                "低于最高价格",
-                                current_unacceptable,
-                                "高于理想价格",
-                                current_ideal,
-                                "，刷新价格",
-                            )
-                            self.buybot.refresh(is_convertible=current_convertible)
-                            # 刷新后仍在商品页面，保持in_product_page=True
-                        elif lowest_price <= current_ideal:
-                            print(
-                                "当前价格：",
-                                lowest_price,
-                                "低于理想价格",
-                                current_ideal,
-                                "，开始购买",
-                            )
-                            self.buybot.buy(is_convertible=current_convertible)
-                            # 购买后仍在商品页面，保持in_product_page=True
-
-                    # 周期性强制垃圾回收
-                    gc.collect()
-
-                except Exception as e:
-                    print(f"操作失败: {str(e)}")
-                    in_product_page = False  # 出错时重置状态，下次重新进入
-                self.msleep(self.loop_gap)
-            else:
-                in_product_page = False  # 不运行时重置状态
-                self.msleep(100)
+        self.loop.run_forever()
 
     def update_params(self, ideal, unacceptable, convertible, key_mode, loop_gap):
         """线程安全更新参数"""
-        self.param_lock.lock()
-        self.ideal_price = ideal
-        self.unacceptable_price = unacceptable
-        self.loop_gap = loop_gap
-        self.is_convertible = convertible
-        self.is_key_mode = key_mode
-        self.param_lock.unlock()
+        self.loop.update_params(ideal, unacceptable, convertible, key_mode, loop_gap)
 
     def set_running(self, state):
         """线程安全更新运行状态"""
-        self.lock.lock()
-        self._is_running = state
-        self.lock.unlock()
+        self.loop.set_running(state)
 
 
-def runApp():
+def runApp(http_port=0, ledger=None, on_limit="stop"):
     app = QtWidgets.QApplication([])
     window = QtWidgets.QMainWindow()
     mainWindow = Ui_MainWindow()
@@ -186,19 +127,44 @@ def runApp():
     mainWindow.textEdit_loop_gap.setText("150")
     mainWindow.is_convertiable.setChecked(True)
     mainWindow.is_key_mode.setChecked(False)
+    mainWindow.statusbar.showMessage("正在后台加载OCR模型，F8 暂不可用")
 
-    # 创建监控线程
+    # 创建监控线程，OCR模型放到后台加载
     key_monitor = KeyMonitor()
-    worker = Worker(BuyBot(ocr_engine="easyocr"))
+    buybot = BuyBot(
+        ocr_engine="easyocr",
+        screenshot_method="auto",
+        load_ocr=False,
+        ocr_cache_path="ocr_cache.json",
+        layout_path="layout.json",
+    )
+    worker = Worker(buybot, ledger=ledger, on_limit=on_limit)
+    ocr_loader = OcrLoader(buybot)
+
+    def handle_ocr_ready(ok, message):
+        mainWindow.statusbar.showMessage(message)
+
+    ocr_loader.ready.connect(handle_ocr_ready)
 
     # 信号连接
     def handle_key_event(x):
         if x == 0:
+            # 预热完成前忽略F8
+            if not buybot.is_ready:
+                print("OCR尚未就绪，请等待初始化完成")
+                return
             worker.record_mouse_position()
         worker.set_running(x == 0)
 
     key_monitor.key_pressed.connect(handle_key_event)
 
+    def handle_price_update(price):
+        mainWindow.label_lowest_price_value.setText(
+            "识别失败" if price is None else str(price)
+        )
+
+    worker.update_signal.connect(handle_price_update)
+
     def handle_text_change():
         try:
             ideal = int(mainWindow.textEdit_ideal_price.toPlainText())
@@ -211,20 +177,65 @@ def runApp():
         except ValueError:
             mainWindow.label_lowest_price_value.setStyleSheet("color: red;")
 
+    # 输入防抖：停止输入300ms后才解析并下发参数，避免每次按键都更新
+    param_timer = QtCore.QTimer()
+    param_timer.setSingleShot(True)
+    param_timer.setInterval(300)
+    param_timer.timeout.connect(handle_text_change)
+
+    def schedule_text_change(*_):
+        # stateChanged带int参数，不能直接连到QTimer.start(msec)
+        param_timer.start()
+
     # 确保两个输入框都连接
-    mainWindow.textEdit_ideal_price.textChanged.connect(handle_text_change)
-    mainWindow.textEdit_unacceptable_price.textChanged.connect(handle_text_change)
-    mainWindow.textEdit_loop_gap.textChanged.connect(handle_text_change)
-    mainWindow.is_convertiable.stateChanged.connect(handle_text_change)
-    mainWindow.is_key_mode.stateChanged.connect(handle_text_change)
+    mainWindow.textEdit_ideal_price.textChanged.connect(schedule_text_change)
+    mainWindow.textEdit_unacceptable_price.textChanged.connect(schedule_text_change)
+    mainWindow.textEdit_loop_gap.textChanged.connect(schedule_text_change)
+    mainWindow.is_convertiable.stateChanged.connect(schedule_text_change)
+    mainWindow.is_key_mode.stateChanged.connect(schedule_text_change)
+    # 下发一次初始参数
+    handle_text_change()
+
+    # 可选的本地HTTP控制与监控接口
+    if http_port:
+        start_http_control(worker.loop, http_port)
+
+    # 退出时保存OCR缓存
+    if buybot.ocr_cache is not None:
+        app.aboutToQuit.connect(buybot.ocr_cache.save)
 
     window.show()
+    ocr_loader.start()
     worker.start()
     app.exec_()
 
 
 def main():
-    return runApp()
+    parser = argparse.ArgumentParser(description="DFMarketBot")
+    parser.add_argument(
+        "--profile-imports", action="store_true", help="输出各依赖的导入耗时后退出"
+    )
+    parser.add_argument(
+        "--http-port", type=int, default=0, help="启用本地HTTP控制与监控接口"
+    )
+    parser.add_argument("--ledger-path", default="ledger.json", help="账本文件")
+    parser.add_argument("--budget", type=int, default=0, help="总花费上限，0不限制")
+    parser.add_argument("--max-units", type=int, default=0, help="总数量上限，0不限制")
+    parser.add_argument(
+        "--on-limit",
+        choices=["stop", "refresh_only"],
+        default="stop",
+        help="达到上限后停止循环或只免费刷新",
+    )
+    args = parser.parse_args()
+
+    if args.profile_imports:
+        profile_imports()
+        return 0
+    ledger = SpendLedger(
+        path=args.ledger_path or None, budget=args.budget, max_units=args.max_units
+    )
+    return runApp(http_port=args.http_port, ledger=ledger, on_limit=args.on_limit)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,398 @@
+"""
+无界面运行模式，不依赖Qt和全局键盘钩子
+
+用法:
+    python DFMarketBotHeadless.py --config config.json
+    python DFMarketBotHeadless.py --ideal-price 300 --unacceptable-price 350 --item-position 500 600 --autostart
+
+运行中通过本地socket控制（每行一个命令）:
+    start / stop / status / quit
+例如: echo start | nc 127.0.0.1 8765
+Linux等支持的系统上还可以用信号: SIGUSR1 开始, SIGUSR2 停止, SIGINT/SIGTERM 退出
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from backend.BuyBot import BuyBot
+from backend.BotLoop import BotLoop
+from backend.http_control import start_http_control
+from backend.ledger import SpendLedger
+from backend.coordinator import CoordinatorClient
+from backend.trace import TraceRecorder
+from backend.recovery import FailureTracker
+from backend.utils import set_replay_frames
+
+DEFAULT_CONFIG = {
+    "ideal_price": 0,
+    "unacceptable_price": 0,
+    "loop_gap": 150,
+    "is_convertible": True,
+    "key_mode": False,
+    # 商品在商店页面中的位置，像素坐标或屏幕比例
+    "item_position": None,
+    "ocr_engine": "easyocr",
+    # "auto" 使用基准测试选出的最快截图方法
+    "screenshot_method": "auto",
+    "dry_run": False,
+    # 校准工具生成的布局文件，不存在时使用默认的2560x1440布局
+    "layout_path": "layout.json",
+    # 点击购买后确认购买结果区域发生变化；购买点击不会自动重试
+    # 需要先在layout_path中写入确认过的range_purchase_toast
+    "verify_actions": False,
+    "verify_timeout": 0.3,
+    # 购买记账和限额，0表示不限制；账本持久化到ledger_path
+    "item_name": "",
+    "ledger_path": "ledger.json",
+    "budget": 0,
+    "max_units": 0,
+    "item_budget": 0,
+    "item_max_units": 0,
+    # 达到限额后 "stop" 停止循环，"refresh_only" 只免费刷新
+    "on_limit": "stop",
+    # OCR结果缓存条目数和持久化文件，0/空表示不启用
+    "ocr_cache_size": 512,
+    "ocr_cache_path": "ocr_cache.json",
+    # 只缓存置信度不低于该值的识别结果，缓存条目的有效期（秒，0表示不过期）
+    "ocr_cache_min_confidence": 0.8,
+    "ocr_cache_ttl": 21600,
+    "autostart": False,
+    "control_host": "127.0.0.1",
+    "control_port": 8765,
+    # 多实例协调器地址 host:port，空表示独立运行
+    "coordinator": "",
+    # 实例名，默认为 主机名-进程号
+    "instance_id": "",
+    # 由协调器集中OCR，本实例不加载模型
+    "remote_ocr": False,
+    # 回放录制的截图目录代替真实屏幕（配合screenshot_method=replay）
+    "replay_dir": "",
+    "replay_fps": 10.0,
+    # 高频盯住价格区域，变化时才做完整OCR
+    "watch": False,
+    "watch_timeout": 1.0,
+    # 钥匙卡抢购模式（需同时开启key_mode），页面稳定的最长等待时间（秒）
+    "snipe": False,
+    "snipe_settle_timeout": 1.0,
+    # 识别或操作失败后的退避：首次退避秒数、退避上限，
+    # 每连续失败多少次重新进入商品页面，连续失败多少次后停止（0表示不停止）
+    "backoff_base": 0.2,
+    "backoff_max": 10.0,
+    "reenter_after": 3,
+    "stop_after_failures": 0,
+    # 识别失败时保存调试截图的最小间隔（秒）
+    "debug_dump_interval": 30.0,
+    # 会话录制目录，空表示不录制；总大小上限（MB）；是否保存截图（否则只记哈希）
+    "trace_dir": "",
+    "trace_max_mb": 50,
+    "trace_crops": True,
+    # 可选的HTTP/JSON控制与监控接口，0表示不启用
+    "http_port": 0,
+    # 运行时长（秒）和最大循环次数，0表示不限制，便于脚本化跑基准
+    "duration": 0,
+    "max_iterations": 0,
+}
+
+
+def load_config(args):
+    """合并默认配置、配置文件和命令行参数，命令行优先"""
+    config = dict(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            file_config = json.load(f)
+        unknown = set(file_config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError(f"配置文件中有未知的配置项: {sorted(unknown)}")
+        config.update(file_config)
+
+    for key in DEFAULT_CONFIG:
+        value = getattr(args, key, None)
+        if value is not None:
+            config[key] = value
+    return config
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="DFMarketBot 无界面运行模式")
+    parser.add_argument("--config", help="JSON配置文件路径")
+    parser.add_argument("--ideal-price", dest="ideal_price", type=int)
+    parser.add_argument("--unacceptable-price", dest="unacceptable_price", type=int)
+    parser.add_argument("--loop-gap", dest="loop_gap", type=int, help="循环间隔(ms)")
+    parser.add_argument(
+        "--convertible",
+        dest="is_convertible",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+    )
+    parser.add_argument(
+        "--key-mode", dest="key_mode", action=argparse.BooleanOptionalAction, default=None
+    )
+    parser.add_argument(
+        "--item-position", dest="item_position", type=float, nargs=2, metavar=("X", "Y")
+    )
+    parser.add_argument("--ocr-engine", dest="ocr_engine")
+    parser.add_argument("--screenshot-method", dest="screenshot_method")
+    parser.add_argument(
+        "--verify-actions",
+        dest="verify_actions",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+    )
+    parser.add_argument("--verify-timeout", dest="verify_timeout", type=float)
+    parser.add_argument("--item-name", dest="item_name")
+    parser.add_argument("--ledger-path", dest="ledger_path")
+    parser.add_argument("--budget", type=int)
+    parser.add_argument("--max-units", dest="max_units", type=int)
+    parser.add_argument("--item-budget", dest="item_budget", type=int)
+    parser.add_argument("--item-max-units", dest="item_max_units", type=int)
+    parser.add_argument("--on-limit", dest="on_limit", choices=["stop", "refresh_only"])
+    parser.add_argument("--ocr-cache-size", dest="ocr_cache_size", type=int)
+    parser.add_argument("--ocr-cache-path", dest="ocr_cache_path")
+    parser.add_argument(
+        "--ocr-cache-min-confidence", dest="ocr_cache_min_confidence", type=float
+    )
+    parser.add_argument("--ocr-cache-ttl", dest="ocr_cache_ttl", type=float)
+    parser.add_argument("--layout-path", dest="layout_path")
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true", default=None)
+    parser.add_argument("--autostart", action="store_true", default=None)
+    parser.add_argument("--control-host", dest="control_host")
+    parser.add_argument("--control-port", dest="control_port", type=int)
+    parser.add_argument("--coordinator", help="协调器地址 host:port")
+    parser.add_argument("--instance-id", dest="instance_id")
+    parser.add_argument(
+        "--remote-ocr", dest="remote_ocr", action="store_true", default=None
+    )
+    parser.add_argument("--replay-dir", dest="replay_dir")
+    parser.add_argument("--replay-fps", dest="replay_fps", type=float)
+    parser.add_argument("--watch", action="store_true", default=None)
+    parser.add_argument("--watch-timeout", dest="watch_timeout", type=float)
+    parser.add_argument("--snipe", action="store_true", default=None)
+    parser.add_argument(
+        "--snipe-settle-timeout", dest="snipe_settle_timeout", type=float
+    )
+    parser.add_argument("--backoff-max", dest="backoff_max", type=float)
+    parser.add_argument(
+        "--stop-after-failures",
+        dest="stop_after_failures",
+        type=int,
+        help="连续失败多少次后停止循环",
+    )
+    parser.add_argument("--trace-dir", dest="trace_dir", help="会话录制目录")
+    parser.add_argument("--trace-max-mb", dest="trace_max_mb", type=float)
+    parser.add_argument("--http-port", dest="http_port", type=int)
+    parser.add_argument("--duration", type=float)
+    parser.add_argument("--max-iterations", dest="max_iterations", type=int)
+    return parser
+
+
+class ControlServer:
+    """本地socket控制，每个连接读取一行命令并返回一行JSON"""
+
+    # 单个连接读取命令和发送回复的超时（秒）
+    CONN_TIMEOUT = 5.0
+
+    def __init__(self, loop, host, port, on_quit):
+        self.loop = loop
+        self.on_quit = on_quit
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(4)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return  # socket已关闭
+            with conn:
+                try:
+                    # 不发命令的客户端不能卡住唯一的accept线程，超时会抛出socket.timeout(OSError)
+                    conn.settimeout(self.CONN_TIMEOUT)
+                    command = conn.makefile("r").readline().strip().lower()
+                    conn.sendall((json.dumps(self.handle(command)) + "\n").encode())
+                except OSError as e:
+                    print(f"控制连接出错: {e}")
+
+    def handle(self, command):
+        if command == "start":
+            blocker = self.loop.start_blocker()
+            if blocker is not None:
+                return {"ok": False, "error": blocker}
+            self.loop.set_running(True)
+        elif command == "stop":
+            self.loop.set_running(False)
+        elif command == "quit":
+            self.on_quit()
+        elif command != "status":
+            return {"ok": False, "error": f"未知命令: {command}"}
+        return {
+            "ok": True,
+            "running": self.loop.is_running(),
+            "iterations": self.loop.iterations,
+            "lowest_price": self.loop.buybot.lowest_price,
+            "units_bought": self.loop.buybot.units_bought,
+        }
+
+    def close(self):
+        self.sock.close()
+
+
+def run(config):
+    if config["item_position"] is None:
+        raise ValueError("无界面模式需要通过item_position指定商品位置")
+
+    if config["replay_dir"]:
+        set_replay_frames(config["replay_dir"], fps=config["replay_fps"])
+
+    coordinator = None
+    if config["coordinator"]:
+        item = config["item_name"] or ",".join(
+            str(v) for v in config["item_position"]
+        )
+        instance_id = config["instance_id"] or f"{socket.gethostname()}-{os.getpid()}"
+        coordinator = CoordinatorClient(config["coordinator"], instance_id, [item])
+
+    buybot = BuyBot(
+        ocr_engine="remote" if config["remote_ocr"] else config["ocr_engine"],
+        ocr_client=coordinator,
+        screenshot_method=config["screenshot_method"],
+        dry_run=config["dry_run"],
+        ocr_cache_size=config["ocr_cache_size"],
+        ocr_cache_path=config["ocr_cache_path"] or None,
+        ocr_cache_min_confidence=config["ocr_cache_min_confidence"],
+        ocr_cache_ttl=config["ocr_cache_ttl"],
+        verify_actions=config["verify_actions"],
+        verify_timeout=config["verify_timeout"],
+        layout_path=config["layout_path"] or None,
+        debug_dump_interval=config["debug_dump_interval"],
+    )
+    ledger = SpendLedger(
+        path=config["ledger_path"] or None,
+        budget=config["budget"],
+        max_units=config["max_units"],
+        item_budget=config["item_budget"],
+        item_max_units=config["item_max_units"],
+    )
+    recorder = None
+    if config["trace_dir"]:
+        recorder = TraceRecorder(
+            config["trace_dir"],
+            max_bytes=int(config["trace_max_mb"] * 1024 * 1024),
+            store_crops=config["trace_crops"],
+        )
+        print(f"会话录制: {config['trace_dir']}")
+    loop = BotLoop(
+        buybot,
+        ledger=ledger,
+        on_limit=config["on_limit"],
+        coordinator=coordinator,
+        watch=config["watch"],
+        watch_timeout=config["watch_timeout"],
+        snipe=config["snipe"],
+        snipe_settle_timeout=config["snipe_settle_timeout"],
+        recorder=recorder,
+        failures=FailureTracker(
+            base_delay=config["backoff_base"],
+            max_delay=config["backoff_max"],
+            reenter_after=config["reenter_after"],
+            stop_after=config["stop_after_failures"],
+        ),
+    )
+    loop.set_item_name(config["item_name"])
+    loop.update_params(
+        config["ideal_price"],
+        config["unacceptable_price"],
+        config["is_convertible"],
+        config["key_mode"],
+        config["loop_gap"],
+    )
+    loop.record_mouse_position(config["item_position"])
+
+    control = None
+    if config["control_port"]:
+        control = ControlServer(
+            loop, config["control_host"], config["control_port"], loop.quit
+        )
+        control.start()
+        print(f"控制端口: {config['control_host']}:{config['control_port']}")
+
+    http_server = None
+    if config["http_port"]:
+        http_server = start_http_control(
+            loop, config["http_port"], host=config["control_host"]
+        )
+
+    signal.signal(signal.SIGINT, lambda *_: loop.quit())
+    signal.signal(signal.SIGTERM, lambda *_: loop.quit())
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda *_: loop.set_running(True))
+        signal.signal(signal.SIGUSR2, lambda *_: loop.set_running(False))
+
+    def watchdog():
+        # 达到运行时长或循环次数后退出
+        start = time.perf_counter()
+        while not loop.is_quitting():
+            if config["duration"] and time.perf_counter() - start >= config["duration"]:
+                loop.quit()
+            if config["max_iterations"] and loop.iterations >= config["max_iterations"]:
+                loop.quit()
+            time.sleep(0.05)
+
+    if config["duration"] or config["max_iterations"]:
+        threading.Thread(target=watchdog, daemon=True).start()
+
+    if config["autostart"]:
+        loop.set_running(True)
+        print("开始循环")
+
+    # 主循环放到子线程，主线程只负责响应信号
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    while thread.is_alive():
+        thread.join(0.2)
+    elapsed = time.perf_counter() - start
+
+    if control is not None:
+        control.close()
+    if http_server is not None:
+        http_server.shutdown()
+    if loop.snipe:
+        report = loop.snipe_report()
+        print(f"抢购延迟分布(ms): 刷新->读价 {report['refresh_to_read_ms']}")
+        print(f"抢购延迟分布(ms): 刷新->点击 {report['refresh_to_click_ms']}")
+        if report["unverified_buys"]:
+            print(f"抢购：{report['unverified_buys']} 次购买未能确认成交，请在游戏内核对")
+    if coordinator is not None:
+        coordinator.close()
+    if recorder is not None:
+        recorder.close()
+    if buybot.ocr_cache is not None:
+        buybot.ocr_cache.save()
+        print(f"OCR缓存: {buybot.ocr_cache.stats()}")
+    print(
+        f"运行结束，共 {loop.iterations} 次循环，耗时 {elapsed:.1f}s，"
+        f"平均 {loop.iterations / max(elapsed, 1e-9):.2f} 次/秒，"
+        f"确认买到 {buybot.units_bought} 个，本次花费 {ledger.session_spend}"
+    )
+    return 0
+
+
+def main():
+    config = load_config(build_parser().parse_args())
+    return run(config)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,597 @@
+import gc  # 添加垃圾回收模块
+import threading
+import time
+from collections import deque
+
+if __name__ == "__main__":
+    from utils import *
+    from metrics import percentiles
+    from recovery import FailureTracker
+else:
+    from backend.utils import *
+    from backend.metrics import percentiles
+    from backend.recovery import FailureTracker
+
+
+def decide(lowest_price, ideal_price, unacceptable_price, key_mode):
+    """
+    根据当前底价决定本次循环的动作，不涉及任何界面和鼠标操作
+    返回值: "freerefresh" 免费刷新（重进商品页面）
+            "refresh"     买1个来刷新价格
+            "buy"         最大数量购买
+            "buy_one_and_stop" 钥匙卡模式下买一张后结束循环
+    """
+    if key_mode:
+        # 钥匙卡模式
+        if lowest_price > ideal_price:
+            return "freerefresh"
+        return "buy_one_and_stop"
+
+    # 正常模式
+    if lowest_price > unacceptable_price:
+        return "freerefresh"
+    if lowest_price > ideal_price:
+        return "refresh"
+    return "buy"
+
+
+class BotLoop:
+    """
+    与界面无关的购买主循环，GUI的Worker线程和无界面运行模式共用
+    on_price: 每次识别出价格后的回调
+    on_stop: 循环自行停止（例如钥匙卡买到后）时的回调
+    ledger: 购买记账，达到预算或数量上限后按on_limit处理
+    on_limit: "stop" 停止循环，"refresh_only" 之后只免费刷新不再购买
+    coordinator: 多实例协调器客户端，物品未分配给本实例时待命，
+                 共享价格低于理想价格才自己读价
+    watch: 开启后用RegionWatcher高频盯住价格区域，画面变化时才做完整OCR，
+           watch_timeout秒内没有变化则沿用上次的价格
+    snipe: 钥匙卡模式下使用抢购流程（见snipe_step）
+    recorder: 会话录制（backend.trace.TraceRecorder），每次循环写入一条记录
+    failures: 失败状态机（backend.recovery.FailureTracker），决定退避时间和恢复方式，
+              默认使用FailureTracker()
+    """
+
+    def __init__(
+        self,
+        buybot,
+        on_price=None,
+        on_stop=None,
+        ledger=None,
+        on_limit="stop",
+        coordinator=None,
+        watch=False,
+        watch_timeout=1.0,
+        snipe=False,
+        snipe_settle_timeout=1.0,
+        recorder=None,
+        failures=None,
+    ):
+        if on_limit not in ["stop", "refresh_only"]:
+            raise ValueError("on_limit 仅支持 'stop' 或 'refresh_only'")
+        self.buybot = buybot
+        self.on_price = on_price
+        self.on_stop = on_stop
+        self.ledger = ledger
+        self.on_limit = on_limit
+        self.coordinator = coordinator
+        self.watch = watch
+        self.watch_timeout = watch_timeout
+        self._watchers = {}  # 是否可兑换 -> RegionWatcher
+        self.snipe = snipe
+        self.snipe_settle_timeout = snipe_settle_timeout
+        # 抢购模式下 刷新->读到价格、刷新->点击购买 的耗时（毫秒）
+        self.snipe_read_latencies = deque(maxlen=1000)
+        self.snipe_click_latencies = deque(maxlen=1000)
+        # 已点击购买但未能确认成交的次数
+        self.snipe_unverified = 0
+        self.recorder = recorder
+        self.failures = failures if failures is not None else FailureTracker()
+
+        self.ideal_price = 0
+        self.unacceptable_price = 0
+        self.loop_gap = 0
+        self.is_convertible = True
+        self.is_key_mode = False
+        self.mouse_position = []
+        # 记账用的物品名，为空时用商品位置代替
+        self.item_name = ""
+        self.param_lock = threading.Lock()  # 参数专用锁
+
+        self._running = threading.Event()
+        self._quit = threading.Event()
+        # 运行状态变化或退出时唤醒循环间隔和退避中的等待
+        self._wake = threading.Event()
+        self.in_product_page = False
+        self.iterations = 0
+        self.last_action = None
+        # 本次循环使用的价格和decide()的决策（限额检查之前），供会话录制使用
+        self.last_price = None
+        self.last_decision = None
+        # 本次循环的失败类型，见backend.recovery.RECOVERY，成功时为None
+        self.last_failure = None
+        self.metrics = buybot.metrics
+
+    def record_mouse_position(self, position=None):
+        """记录商品位置，默认使用鼠标当前位置"""
+        if position is None:
+            position = get_mouse_position()
+        with self.param_lock:
+            self.mouse_position = list(position)
+
+    def set_item_name(self, name):
+        with self.param_lock:
+            self.item_name = name
+
+    def current_item(self):
+        """记账用的物品标识"""
+        with self.param_lock:
+            if self.item_name:
+                return self.item_name
+            return ",".join(str(v) for v in self.mouse_position)
+
+    def update_params(self, ideal, unacceptable, convertible, key_mode, loop_gap):
+        """线程安全更新参数"""
+        with self.param_lock:
+            self.ideal_price = ideal
+            self.unacceptable_price = unacceptable
+            self.loop_gap = loop_gap
+            self.is_convertible = convertible
+            self.is_key_mode = key_mode
+
+    def get_params(self):
+        """返回当前参数的副本"""
+        with self.param_lock:
+            return {
+                "ideal_price": self.ideal_price,
+                "unacceptable_price": self.unacceptable_price,
+                "is_convertible": self.is_convertible,
+                "key_mode": self.is_key_mode,
+                "loop_gap": self.loop_gap,
+            }
+
+    def set_params(self, **params):
+        """只更新给出的参数，其余保持不变"""
+        current = self.get_params()
+        unknown = set(params) - set(current)
+        if unknown:
+            raise ValueError(f"未知参数: {sorted(unknown)}")
+        current.update(params)
+        self.update_params(
+            int(current["ideal_price"]),
+            int(current["unacceptable_price"]),
+            bool(current["is_convertible"]),
+            bool(current["key_mode"]),
+            int(current["loop_gap"]),
+        )
+
+    def state(self):
+        """当前运行状态，供控制接口查询"""
+        return {
+            "running": self.is_running(),
+            "in_product_page": self.in_product_page,
+            "iterations": self.iterations,
+            "lowest_price": self.buybot.lowest_price,
+            "last_action": self.last_action,
+            "units_bought": self.buybot.units_bought,
+            "ledger": self.ledger.summary() if self.ledger is not None else None,
+            "snipe": self.snipe_report() if self.snipe else None,
+            "failures": self.failures.snapshot(),
+            "params": self.get_params(),
+            "ocr_cache": (
+                self.buybot.ocr_cache.stats()
+                if self.buybot.ocr_cache is not None
+                else None
+            ),
+        }
+
+    def start_blocker(self):
+        """不能开始循环的原因，可以开始时返回None"""
+        if not self.buybot.is_ready:
+            return "OCR尚未就绪，请等待初始化完成"
+        with self.param_lock:
+            if not self.mouse_position:
+                return "尚未记录商品位置"
+        return None
+
+    def set_running(self, state):
+        """线程安全更新运行状态，重新开始时从正常速度开始，不沿用上次的退避"""
+        if state:
+            if not self._running.is_set():
+                self.failures.reset()
+            self._running.set()
+        else:
+            self._running.clear()
+        self._wake.set()
+
+    def is_running(self):
+        return self._running.is_set()
+
+    def is_quitting(self):
+        return self._quit.is_set()
+
+    def quit(self):
+        """结束run_forever"""
+        self._running.clear()
+        self._quit.set()
+        self._wake.set()
+
+    def step(self):
+        """执行一次检测+决策+操作"""
+        # 获取当前参数值
+        with self.param_lock:
+            current_ideal = self.ideal_price
+            current_unacceptable = self.unacceptable_price
+            current_convertible = self.is_convertible
+            current_key_mode = self.is_key_mode
+            mouse_position = self.mouse_position
+
+        item = self.current_item()
+        self.last_price = None
+        self.last_decision = None
+        self.last_failure = None
+
+        # 多实例时，同一物品只由被分配的实例轮询
+        if self.coordinator is not None and not self.coordinator.is_assigned(item):
+            shared_price = self.coordinator.latest_price(item)
+            if shared_price is None or shared_price > current_ideal:
+                self.last_action = "standby"
+                return "standby"
+            print(f"其他实例观测到价格 {shared_price}，低于理想价格，开始读价")
+
+        if current_key_mode and self.snipe:
+            action = self.snipe_step(current_ideal, mouse_position, item)
+            self.last_action = action
+            self.iterations += 1
+            return action
+
+        # 仅在需要时进入商品页面
+        if not self.in_product_page:
+            self.buybot.click(mouse_position, num=1)
+            self.in_product_page = True
+
+        # 检测逻辑
+        lowest_price = None
+        watcher = self.get_watcher(current_convertible) if self.watch else None
+        if watcher is not None and self.buybot.lowest_price is not None:
+            with self.metrics.timer("watch"):
+                changed, _ = watcher.wait_change(timeout=self.watch_timeout)
+            if not changed:
+                # 价格区域没有变化，沿用上次识别的价格
+                self.metrics.incr("watch_skips")
+                lowest_price = self.buybot.lowest_price
+        if lowest_price is None:
+            with self.metrics.timer("detect"):
+                lowest_price = self.buybot.detect_price(
+                    is_convertible=current_convertible, debug_mode=False
+                )
+            if watcher is not None:
+                watcher.reset()
+        self.last_price = lowest_price
+        if self.on_price is not None:
+            self.on_price(lowest_price)
+        if self.coordinator is not None:
+            self.coordinator.report(item, lowest_price)
+
+        if lowest_price is None:
+            # 识别失败时不做决策，由run_forever按失败类型恢复和退避
+            self.last_failure = self.buybot.last_failure or "no_text"
+            self.last_action = "detect_failed"
+            self.iterations += 1
+            return "detect_failed"
+
+        action = decide(
+            lowest_price, current_ideal, current_unacceptable, current_key_mode
+        )
+        self.last_decision = action
+        action = self.apply_limits(action, item, lowest_price)
+        self.last_action = action
+        action_start = time.perf_counter()
+        if action == "limit_stop":
+            print("已达到预算或数量上限，停止循环")
+            self.set_running(False)
+            self.in_product_page = False
+            if self.on_stop is not None:
+                self.on_stop()
+        elif action == "freerefresh":
+            print(
+                "当前价格：",
+                lowest_price,
+                "高于理想价格" if current_key_mode else "高于最高价格",
+                current_ideal if current_key_mode else current_unacceptable,
+                "，免费刷新价格",
+            )
+            self.buybot.freerefresh(good_postion=mouse_position)
+            # 已经重新进入商品页面，保持in_product_page=True
+        elif action == "buy_one_and_stop":
+            print(
+                "当前价格：",
+                lowest_price,
+                "低于理想价格",
+                current_ideal,
+                "，购买一张后循环结束",
+            )
+            ok = self.buybot.refresh(is_convertible=False)
+            self.record_purchase(item, 1, lowest_price, verified=ok)
+            # 只买一张：无论是否确认买到都停止，未确认时由用户核对，不再重复购买
+            if not ok:
+                print("未确认是否买到，请在游戏内核对")
+            self.set_running(False)
+            print("停止循环")
+            self.in_product_page = False  # 循环停止，重置状态
+            if self.on_stop is not None:
+                self.on_stop()
+        elif action == "refresh":
+            print(
+                "当前价格：",
+                lowest_price,
+                "低于最高价格",
+                current_unacceptable,
+                "高于理想价格",
+                current_ideal,
+                "，刷新价格",
+            )
+            ok = self.buybot.refresh(is_convertible=current_convertible)
+            self.record_purchase(item, 1, lowest_price, verified=ok)
+            # 刷新后仍在商品页面，保持in_product_page=True
+        elif action == "buy":
+            print(
+                "当前价格：",
+                lowest_price,
+                "低于理想价格",
+                current_ideal,
+                "，开始购买",
+            )
+            ok = self.buybot.buy(is_convertible=current_convertible)
+            self.record_purchase(
+                item, self.buybot.max_shopping_number, lowest_price, verified=ok
+            )
+            # 购买后仍在商品页面，保持in_product_page=True
+        self.metrics.observe("action", time.perf_counter() - action_start)
+
+        self.iterations += 1
+        return action
+
+    def snipe_step(self, current_ideal, mouse_position, item):
+        """
+        钥匙卡抢购，尽量缩短 刷新->读价->购买 的关键路径：
+        1. Esc后重新点进商品页面（首次直接点进）
+        2. 鼠标立即移到购买按钮上等待
+        3. 价格区域出现变化并稳定后马上读价（OCR缓存命中时不跑OCR）
+        4. 价格不高于理想价格时原地点击购买，不再移动鼠标
+        钥匙卡默认购买数量为1，这里不再点击最小数量
+        """
+        buybot = self.buybot
+        buy_button = buybot.postion_notconvertiable_buy_button
+        watcher = self.get_watcher(False)
+
+        watcher.reset()
+        refresh_start = time.perf_counter()
+        if self.in_product_page:
+            buybot.press("esc")
+            self.metrics.incr("free_refreshes")
+        buybot.click(mouse_position)
+        self.in_product_page = True
+        buybot.move_to(buy_button)
+
+        # 等页面切换完成：先等价格区域变化（价格相同时可能没有变化，超时即可），再等稳定
+        with self.metrics.timer("snipe_settle"):
+            watcher.wait_change(timeout=self.snipe_settle_timeout / 3)
+            watcher.wait_stable(timeout=self.snipe_settle_timeout)
+
+        outcome_baseline = None
+        if buybot.verify_actions and not buybot.dry_run:
+            # 鼠标已经在购买按钮上，此时截取购买结果区域作为基准
+            outcome_baseline = buybot.capture_ranges(
+                buybot.outcome_ranges(False, min_quantity=True)
+            )
+        lowest_price = buybot.detect_price(is_convertible=False)
+        read_latency = time.perf_counter() - refresh_start
+        self.metrics.observe("snipe_refresh_to_read", read_latency)
+        self.snipe_read_latencies.append(read_latency * 1000)
+        self.last_price = lowest_price
+        if self.on_price is not None:
+            self.on_price(lowest_price)
+        if self.coordinator is not None:
+            self.coordinator.report(item, lowest_price)
+
+        if lowest_price is None:
+            # 下次循环本来就会重新进入页面，这里只记录失败用于退避
+            self.last_failure = self.buybot.last_failure or "no_text"
+            return "detect_failed"
+        if lowest_price > current_ideal:
+            self.last_decision = "freerefresh"
+            return "freerefresh"
+        self.last_decision = "buy_one_and_stop"
+        action = self.apply_limits("buy_one_and_stop", item, lowest_price)
+        if action == "limit_stop":
+            print("已达到预算或数量上限，停止循环")
+            self.set_running(False)
+            self.in_product_page = False
+            if self.on_stop is not None:
+                self.on_stop()
+            return action
+        if action != "buy_one_and_stop":
+            return action
+
+        click_latency = time.perf_counter() - refresh_start
+        ok = buybot.buy_in_place(
+            buy_button, is_convertible=False, baseline=outcome_baseline
+        )
+        self.metrics.observe("snipe_refresh_to_click", click_latency)
+        self.snipe_click_latencies.append(click_latency * 1000)
+        print(
+            f"抢购：价格 {lowest_price} 低于理想价格 {current_ideal}，"
+            f"刷新到点击耗时 {click_latency * 1000:.0f}ms"
+        )
+        self.record_purchase(item, 1, lowest_price, verified=ok)
+        # 购买点击已经发出，未确认时也停止，只报告不重复购买
+        if not ok:
+            self.snipe_unverified += 1
+            print("抢购：未确认是否买到，请在游戏内核对")
+        self.set_running(False)
+        print("停止循环")
+        self.in_product_page = False
+        if self.on_stop is not None:
+            self.on_stop()
+        return action
+
+    def snipe_report(self):
+        """抢购模式的延迟分布（毫秒）"""
+        return {
+            "refresh_to_read_ms": percentiles(self.snipe_read_latencies),
+            "refresh_to_click_ms": percentiles(self.snipe_click_latencies),
+            "unverified_buys": self.snipe_unverified,
+        }
+
+    def get_watcher(self, is_convertible):
+        """价格区域的RegionWatcher，按是否可兑换分别创建"""
+        watcher = self._watchers.get(is_convertible)
+        if watcher is None:
+            screenshot_range = (
+                self.buybot.range_isconvertible_lowest_price
+                if is_convertible
+                else self.buybot.range_notconvertible_lowest_price
+            )
+            watcher = RegionWatcher(
+                screenshot_range, method=self.buybot.screenshot_method
+            )
+            self._watchers[is_convertible] = watcher
+        return watcher
+
+    def apply_limits(self, action, item, price):
+        """
+        购买前检查账本限额，超出时把动作改为免费刷新或停止
+        """
+        if self.ledger is None:
+            return action
+        if action == "buy":
+            units = self.buybot.max_shopping_number
+        elif action in ["refresh", "buy_one_and_stop"]:
+            units = 1
+        else:
+            return action
+        if self.ledger.allows(item, units, price):
+            return action
+        self.metrics.incr("limit_hits")
+        if self.on_limit == "refresh_only":
+            print("已达到预算或数量上限，只免费刷新不再购买")
+            return "freerefresh"
+        return "limit_stop"
+
+    def record_trace(self, action, elapsed, error=None):
+        """把本次循环写入会话录制，截图和OCR结果取自BuyBot最近一次识别"""
+        buybot = self.buybot
+        timings = {
+            stage: seconds * 1000 for stage, seconds in buybot.last_timings.items()
+        }
+        timings["iteration"] = elapsed * 1000
+        entry = {
+            "t": time.time(),
+            "iteration": self.iterations,
+            "item": self.current_item(),
+            "params": self.get_params(),
+            "ocr": buybot.last_ocr,
+            "price": self.last_price,
+            "decision": self.last_decision,
+            "action": action,
+            "failure": self.last_failure,
+            "timings": timings,
+        }
+        if error is not None:
+            entry["error"] = error
+        crop = buybot.last_crop
+        # 用过即清空，沿用上次价格的循环不会重复记录旧截图
+        buybot.last_crop = None
+        buybot.last_ocr = None
+        buybot.last_timings = {}
+        try:
+            self.recorder.record(entry, crop=crop)
+        except OSError as e:
+            print(f"会话录制写入失败: {e}")
+
+    def recover(self, kind):
+        """
+        按失败类型恢复，返回退避时间（秒）
+        no_text等需要重新进入页面的失败：在商品页面时Esc后重新点进（与免费刷新相同），
+        操作异常时页面状态未知，只标记下次循环重新点击商品
+        """
+        self.metrics.incr(f"failure_{kind}")
+        plan = self.failures.failure(kind)
+        if plan["stop"]:
+            print(f"连续失败 {self.failures.consecutive} 次，停止循环")
+            self.set_running(False)
+            self.in_product_page = False
+            if self.on_stop is not None:
+                self.on_stop()
+            return 0.0
+        if plan["reenter"]:
+            self.metrics.incr("reentries")
+            with self.param_lock:
+                mouse_position = self.mouse_position
+                snipe = self.snipe and self.is_key_mode
+            if snipe:
+                # 抢购流程每次循环都会Esc后重新点进商品页面，保持in_product_page，
+                # 否则snipe_step不按Esc，会在商品页面上点击商店列表的位置
+                pass
+            elif kind == "action" or not self.in_product_page:
+                self.in_product_page = False
+            else:
+                try:
+                    self.buybot.freerefresh(good_postion=mouse_position)
+                except Exception as e:
+                    print(f"重新进入商品页面失败: {e}")
+                    self.in_product_page = False
+        self.metrics.incr("backoffs")
+        print(
+            f"{kind} 失败（连续 {self.failures.consecutive} 次），"
+            f"{'重新进入商品页面，' if plan['reenter'] else ''}"
+            f"{plan['delay']:.1f}秒后重试"
+        )
+        return plan["delay"]
+
+    def record_purchase(self, item, units, price, verified=True):
+        """
+        每次点击购买后记账，dry_run时不记
+        未确认的购买也可能已经成交，同样计入限额，只在账本中单独标记
+        """
+        if self.ledger is None or self.buybot.dry_run:
+            return
+        self.ledger.record(item, units, price, verified=verified)
+
+    def run_forever(self):
+        """主循环，直到调用quit()"""
+        while not self._quit.is_set():
+            if self._running.is_set():
+                self._wake.clear()
+                iteration_start = time.perf_counter()
+                action, error = None, None
+                try:
+                    action = self.step()
+                    # 周期性强制垃圾回收
+                    gc.collect()
+                except Exception as e:
+                    self.metrics.incr("failures")
+                    error = str(e)
+                    print(f"操作失败: {error}")
+                    self.last_failure = "action"
+                elapsed = time.perf_counter() - iteration_start
+                self.metrics.observe("iteration", elapsed)
+                if self.recorder is not None:
+                    self.record_trace(action, elapsed, error=error)
+
+                backoff = 0.0
+                if self.last_failure is not None:
+                    backoff = self.recover(self.last_failure)
+                elif action != "standby":
+                    self.failures.success()
+                with self.param_lock:
+                    loop_gap = self.loop_gap
+                # 开始、停止和退出都会打断循环间隔和退避
+                self._wake.wait(loop_gap / 1000 + backoff)
+            else:
+                self.in_product_page = False  # 不运行时重置状态
+                if self.recorder is not None:
+                    # 停止后不再有新记录触发刷新，把最后几条写入磁盘
+                    self.recorder.flush()
+                self._running.wait(0.1)
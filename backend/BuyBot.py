@@ -1,30 +1,102 @@
-import easyocr
 import numpy as np
 import time
 import os
 import gc  # 添加垃圾回收模块
 import re
+import json
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
+# 界面布局相关的属性，校准工具生成的布局文件中保存的就是这些值
+LAYOUT_KEYS = [
+    "range_isconvertible_lowest_price",
+    "range_notconvertible_lowest_price",
+    "postion_isconvertible_max_shopping_number",
+    "postion_isconvertible_min_shopping_number",
+    "postion_notconvertiable_max_shopping_number",
+    "postion_notconvertiable_min_shopping_number",
+    "postion_isconvertible_buy_button",
+    "postion_notconvertiable_buy_button",
+    "range_isconvertible_quantity",
+    "range_notconvertible_quantity",
+    "range_purchase_toast",
+]
+# 后来加入的布局项，旧的布局文件中没有时沿用默认值
+OPTIONAL_LAYOUT_KEYS = [
+    "range_isconvertible_quantity",
+    "range_notconvertible_quantity",
+    "range_purchase_toast",
+]
+
 if __name__ == "__main__":
     from utils import *
+    from metrics import Metrics
+    from ocr_cache import OcrCache
+    from coordinator import RemoteReader
 else:
     from backend.utils import *
+    from backend.metrics import Metrics
+    from backend.ocr_cache import OcrCache
+    from backend.coordinator import RemoteReader
 
 
 class BuyBot:
-    def __init__(self, ocr_engine="easyocr", screenshot_method="mss"):
+    def __init__(
+        self,
+        ocr_engine="easyocr",
+        screenshot_method="mss",
+        load_ocr=True,
+        dry_run=False,
+        ocr_cache_size=512,
+        ocr_cache_path=None,
+        ocr_cache_min_confidence=0.8,
+        ocr_cache_ttl=6 * 3600,
+        verify_actions=False,
+        verify_timeout=0.3,
+        layout_path=None,
+        ocr_client=None,
+        debug_dump_interval=30.0,
+    ):
+        """
+        load_ocr: 是否在构造时立即加载OCR模型
+        为False时需要之后手动调用load_ocr()，便于在后台线程中加载
+        dry_run: 只识别不点击，用于测试和跑基准
+        ocr_cache_size: OCR结果缓存条目数，为0时不使用缓存
+        ocr_cache_path: OCR结果缓存的持久化文件，为None时只缓存在内存中
+        ocr_cache_min_confidence / ocr_cache_ttl: 只缓存置信度不低于该值的结果，
+            缓存条目在ttl秒后过期，避免一次误识别被长期重复使用
+        verify_actions: 点击购买按钮后确认购买结果区域（数量输入框、购买提示）发生变化，
+            需要布局文件中有人工确认过的range_purchase_toast，否则不生效
+        verify_timeout: 等待画面变化的时限（秒）
+        layout_path: 校准工具生成的布局文件，存在时覆盖默认的2560x1440布局
+        ocr_client: ocr_engine为"remote"时使用的协调器客户端，由协调器集中OCR
+        debug_dump_interval: 识别失败时保存调试截图的最小间隔（秒），避免连续失败时频繁写盘
+        """
         self.ocr_engine = ocr_engine.lower()
         self.screenshot_method = screenshot_method.lower()
-
-        if self.ocr_engine == "easyocr":
-            self.reader = easyocr.Reader(["ch_sim", "en"], gpu=False)
-        else:
-            raise ValueError("ocr_engine 仅支持 'easyocr'")
-
-        if self.screenshot_method not in ["mss", "win32"]:
-            raise ValueError("screenshot_method 仅支持 'mss' 或 'win32'")
+        self.dry_run = dry_run
+        self.verify_actions = verify_actions
+        self.verify_timeout = verify_timeout
+        # 实际确认买到的数量
+        self.units_bought = 0
+        self.reader = None
+        self.is_ready = False
+        self.debug_dump_interval = debug_dump_interval
+        self._last_debug_dump = None
+
+        if self.ocr_engine not in ["easyocr", "remote"]:
+            raise ValueError("ocr_engine 仅支持 'easyocr' 或 'remote'")
+        if self.ocr_engine == "remote" and ocr_client is None:
+            raise ValueError("ocr_engine 为 'remote' 时需要提供 ocr_client")
+        self.ocr_client = ocr_client
+
+        if self.screenshot_method == "auto":
+            # 首次运行时需要现场跑基准测试，load_ocr为False时与OCR模型一起
+            # 由调用方在后台线程中调用select_screenshot_method()
+            if load_ocr:
+                self.select_screenshot_method()
+        elif self.screenshot_method not in SCREENSHOT_METHODS:
+            raise ValueError(f"screenshot_method 仅支持 {SCREENSHOT_METHODS}")
 
         self.range_isconvertible_lowest_price = [
             2179 / 2560,
@@ -44,7 +116,48 @@ class BuyBot:
         self.postion_notconvertiable_min_shopping_number = [2028 / 2560, 1112 / 1440]
         self.postion_isconvertible_buy_button = [2189 / 2560, 0.7979]
         self.postion_notconvertiable_buy_button = [2186 / 2560, 1225 / 1440]
+        # 购买结果区域：购买数量输入框（最小、最大数量按钮之间）和购买提示
+        # 购买提示的默认位置为估计值，校准工具也无法定位，
+        # 布局文件中写入确认过的range_purchase_toast后才会用来确认购买结果
+        self.toast_calibrated = False
+        self.range_isconvertible_quantity = [0.8300, 0.7083, 0.8706, 0.7361]
+        self.range_notconvertible_quantity = [
+            2125 / 2560,
+            1092 / 1440,
+            2231 / 2560,
+            1132 / 1440,
+        ]
+        self.range_purchase_toast = [0.38, 0.10, 0.62, 0.17]
+        # 最大购买数量
+        self.max_shopping_number = 200
+        if layout_path is not None and os.path.exists(layout_path):
+            self.load_layout(layout_path)
+        if self.verify_actions and not self.toast_calibrated:
+            print(
+                "布局文件中没有range_purchase_toast，购买提示位置未确认，"
+                "不确认购买结果"
+            )
+            self.verify_actions = False
         self.lowest_price = None
+        self.last_crop = None
+        self.last_ocr = None
+        self.last_timings = {}
+        # 最近一次识别失败的类型，见backend.recovery.RECOVERY，成功时为None
+        self.last_failure = None
+        # 运行指标，BotLoop和控制接口共用
+        self.metrics = Metrics()
+        # 截图哈希 -> 价格 的缓存，相同画面不再重复OCR
+        self.ocr_cache = (
+            OcrCache(
+                ocr_cache_size,
+                path=ocr_cache_path,
+                engine=self.ocr_engine,
+                min_confidence=ocr_cache_min_confidence,
+                ttl=ocr_cache_ttl,
+            )
+            if ocr_cache_size
+            else None
+        )
 
         # 预编译正则表达式，避免重复编译
         self._digit_pattern = re.compile(r"\d+")
@@ -74,11 +187,100 @@ class BuyBot:
             "z": "2",
         }
 
+        if load_ocr:
+            self.load_ocr()
+            self.warm_up()
+
+    def layout(self):
+        """当前布局，键为LAYOUT_KEYS，值为屏幕比例坐标"""
+        return {key: list(getattr(self, key)) for key in LAYOUT_KEYS}
+
+    def load_layout(self, path):
+        """加载校准工具生成的布局文件"""
+        with open(path, "r", encoding="utf-8") as f:
+            profile = json.load(f)
+        layout = profile["layout"]
+        missing = set(LAYOUT_KEYS) - set(layout) - set(OPTIONAL_LAYOUT_KEYS)
+        if missing:
+            raise ValueError(f"布局文件 {path} 缺少: {sorted(missing)}")
+        for key in LAYOUT_KEYS:
+            if key in layout:
+                setattr(self, key, list(layout[key]))
+        self.toast_calibrated = "range_purchase_toast" in layout
+
+        import pyautogui
+
+        screen = profile.get("screen")
+        screen_size = pyautogui.size()
+        if screen and list(screen) != [screen_size.width, screen_size.height]:
+            print(
+                f"警告: 布局文件是在 {screen[0]}x{screen[1]} 下校准的，"
+                f"当前屏幕为 {screen_size.width}x{screen_size.height}，建议重新校准"
+            )
+        print(f"已加载布局文件: {path}")
+
+    def select_screenshot_method(self):
+        """screenshot_method为"auto"时，使用基准测试选出的最快截图方法（保存在capture_backend.json）"""
+        if self.screenshot_method == "auto":
+            from backend.capture_bench import choose_backend
+
+            self.screenshot_method = choose_backend()
+        return self.screenshot_method
+
+    def load_ocr(self):
+        """
+        加载OCR模型，easyocr（以及其依赖的torch）在这里才导入，避免拖慢启动
+        """
+        if self.reader is not None:
+            return self.reader
+
+        start = time.perf_counter()
+        if self.ocr_engine == "easyocr":
+            self.reader = self.load_local_reader()
+        elif self.ocr_engine == "remote":
+            # 协调器不可达时退回本地easyocr，用到时才加载
+            self.reader = RemoteReader(
+                self.ocr_client, local_factory=self.load_local_reader
+            )
+        print(f"OCR模型加载完成，耗时 {time.perf_counter() - start:.2f}s")
+        return self.reader
+
+    @staticmethod
+    def load_local_reader():
+        import easyocr
+
+        return easyocr.Reader(["ch_sim", "en"], gpu=False)
+
+    def warm_up(self):
+        """
+        用一张空白图片跑一次推理，让模型完成首次调用的初始化开销
+        预热完成后才认为机器人可用
+        """
+        self.load_ocr()
+        start = time.perf_counter()
+        dummy = np.full((24, 129, 3), 255, dtype=np.uint8)
+        self.reader.readtext(dummy)
+        self.is_ready = True
+        print(f"OCR预热完成，耗时 {time.perf_counter() - start:.2f}s")
         print(
             f"初始化完成，当前OCR引擎: {self.ocr_engine}，截图方法: {self.screenshot_method}"
         )
 
     def detect_price(self, is_convertible, debug_mode=False):
+        """识别当前最低价，失败时返回None"""
+        price = self._detect_price(is_convertible, debug_mode=debug_mode)
+        if price is None:
+            self.metrics.incr("failures")
+        self.metrics.record_price(price)
+        return price
+
+    def _detect_price(self, is_convertible, debug_mode=False):
+        # 本次识别的中间结果，供会话录制使用
+        self.last_crop = None
+        self.last_ocr = None
+        self.last_timings = {}
+        self.last_failure = None
+        stage = "capture"  # 出现异常时所处的阶段，即失败类型
         try:
             # 使用指定的截图方法
             screenshot_range = (
@@ -87,52 +289,64 @@ class BuyBot:
                 else self.range_notconvertible_lowest_price
             )
 
-            img_np = get_windowshot(
-                screenshot_range,
-                method=self.screenshot_method,
-                debug_mode=debug_mode,
-            )
+            with self.metrics.timer("capture") as timer:
+                img_np = get_windowshot(
+                    screenshot_range,
+                    method=self.screenshot_method,
+                    debug_mode=debug_mode,
+                )
+            self.last_timings["capture"] = timer.elapsed
+            self.last_crop = img_np
 
             # 检查截图是否成功
             if img_np is None:
                 print(f"{self.screenshot_method}截图失败")
+                self.last_failure = "capture"
                 self.lowest_price = None
                 return self.lowest_price
 
+            # 先查缓存，相同的截图直接复用之前的识别结果
+            cache_key = None
+            if self.ocr_cache is not None:
+                cache_key = self.ocr_cache.key(img_np)
+                cached = self.ocr_cache.get(cache_key)
+                if cached is not None:
+                    self.metrics.incr("cache_hits")
+                    self.last_ocr = "cache"
+                    self.lowest_price = cached[0]
+                    if debug_mode:
+                        print(f"OCR缓存命中: {cached}")
+                    return self.lowest_price
+
             # 优化OCR处理 - 直接处理结果，避免重复变量赋值
-            ocr_results = self.reader.readtext(img_np)
+            stage = "ocr_error"
+            self.metrics.incr("ocr_calls")
+            with self.metrics.timer("ocr") as timer:
+                ocr_results = self.reader.readtext(img_np)
+            self.last_timings["ocr"] = timer.elapsed
+            self.last_ocr = [[str(text), float(conf)] for _, text, conf in ocr_results]
             if debug_mode:
                 print(f"OCR识别结果: {ocr_results}")
 
             # 检查OCR结果是否为空
             if not ocr_results:
                 print("OCR识别结果为空")
+                self.last_failure = "no_text"
+                self.dump_debug_frame(img_np)
                 self.lowest_price = None
                 return self.lowest_price
 
-            # 优化价格提取 - 使用生成器和next()提前退出
-            price_text = next(
-                (
-                    detection[1]
-                    for detection in ocr_results
-                    if any(char.isdigit() for char in detection[1])
-                ),
-                None,
+            stage = "parse"
+            self.lowest_price, price_detection = self.extract_price(
+                ocr_results, debug_mode=debug_mode
             )
-
-            if price_text is None:
-                print("未在OCR结果中找到有效的价格文本")
-                self.lowest_price = None
-                return self.lowest_price
-
-            if debug_mode:
-                print(f"提取到的价格文本: '{price_text}'")
-
-            # 智能清理价格文本并转换为整数
-            self.lowest_price = self.parse_price_text(price_text)
-
             if self.lowest_price is None:
-                print(f"无法解析价格文本: '{price_text}'")
+                self.last_failure = "no_text" if price_detection is None else "parse"
+                self.dump_debug_frame(img_np)
+            elif cache_key is not None:
+                self.ocr_cache.put(
+                    cache_key, self.lowest_price, float(price_detection[2])
+                )
 
             # 清理变量
             del img_np, ocr_results
@@ -140,25 +354,65 @@ class BuyBot:
 
         except Exception as e:
             self.lowest_price = None
+            self.last_failure = stage
             print(f"识别失败, 建议检查物品是否可兑换，错误信息: {e}")
-            # 保存调试图片
-            try:
-                screenshot_range = (
-                    self.range_isconvertible_lowest_price
-                    if is_convertible
-                    else self.range_notconvertible_lowest_price
-                )
-                img_np = get_windowshot(
-                    screenshot_range,
-                    method=self.screenshot_method,
-                    debug_mode=True,
-                )
-                print("已保存调试截图，请检查screenshot_xxx.png文件")
-            except:
-                print("无法保存调试截图")
+            # 保存已经截到的图片，不再为调试重新截图
+            self.dump_debug_frame(self.last_crop)
 
         return self.lowest_price
 
+    def dump_debug_frame(self, img_np):
+        """
+        保存识别失败时的截图，间隔不小于debug_dump_interval
+        返回是否保存
+        """
+        if img_np is None:
+            return False
+        now = time.monotonic()
+        if (
+            self._last_debug_dump is not None
+            and now - self._last_debug_dump < self.debug_dump_interval
+        ):
+            return False
+        self._last_debug_dump = now
+        try:
+            save_debug_screenshot(img_np, self.screenshot_method)
+        except Exception as e:
+            print(f"无法保存调试截图: {e}")
+            return False
+        self.metrics.incr("debug_dumps")
+        print(f"已保存调试截图，请检查screenshot_{self.screenshot_method}.png文件")
+        return True
+
+    def extract_price(self, ocr_results, debug_mode=False):
+        """
+        从OCR结果中取出价格
+        返回 (价格, 对应的识别结果)，失败时价格为None
+        """
+        # 优化价格提取 - 使用生成器和next()提前退出
+        price_detection = next(
+            (
+                detection
+                for detection in ocr_results
+                if any(char.isdigit() for char in detection[1])
+            ),
+            None,
+        )
+
+        if price_detection is None:
+            print("未在OCR结果中找到有效的价格文本")
+            return None, None
+
+        price_text = price_detection[1]
+        if debug_mode:
+            print(f"提取到的价格文本: '{price_text}'")
+
+        # 智能清理价格文本并转换为整数
+        price = self.parse_price_text(price_text)
+        if price is None:
+            print(f"无法解析价格文本: '{price_text}'")
+        return price, price_detection
+
     def parse_price_text(self, price_text):
         """
         优化版价格文本解析，减少重复操作
@@ -274,22 +528,149 @@ class BuyBot:
 
         return "".join(chars)
 
+    def click(self, position, num=1):
+        """
+        点击指定位置，dry_run时只打印不点击
+        position为None时在鼠标当前位置点击，省去移动的时间
+        """
+        if self.dry_run:
+            print(f"[dry_run] 点击 {position or '当前位置'} x{num}")
+            return
+        if position is None:
+            import pyautogui
+
+            for _ in range(num):
+                pyautogui.click()
+            return
+        mouse_click(position, num=num)
+
+    def move_to(self, position):
+        """提前把鼠标移到按钮上，之后可以直接原地点击"""
+        if self.dry_run:
+            print(f"[dry_run] 移动到 {position}")
+            return
+        mouse_move(position)
+
+    def press(self, key):
+        """按键，dry_run时只打印不按键"""
+        if self.dry_run:
+            print(f"[dry_run] 按键 {key}")
+            return
+        import pyautogui
+
+        pyautogui.press(key)
+
+    def outcome_ranges(self, is_convertible, min_quantity=False):
+        """
+        能看出购买结果的区域：购买数量输入框和购买提示
+        min_quantity: 按最小数量购买，数量输入框买前买后都是1，只看购买提示
+        """
+        if min_quantity:
+            return [self.range_purchase_toast]
+        return [
+            (
+                self.range_isconvertible_quantity
+                if is_convertible
+                else self.range_notconvertible_quantity
+            ),
+            self.range_purchase_toast,
+        ]
+
+    def capture_ranges(self, ranges):
+        """截取多个区域，作为确认购买结果的基准"""
+        return [get_windowshot(r, method=self.screenshot_method) for r in ranges]
+
+    def click_verified(
+        self, position, is_convertible, baseline=None, in_place=False, min_quantity=False
+    ):
+        """
+        点击购买按钮并确认购买结果区域的画面发生变化
+        购买点击不能安全地重复，确认失败时不重试，由调用方按未确认的购买处理
+        baseline: 鼠标移到按钮上之后截好的购买结果区域（capture_ranges的返回值）
+        in_place: 鼠标已经在按钮上，不再移动
+        min_quantity: 按最小数量购买，见outcome_ranges
+        返回是否确认成功
+        """
+        if self.dry_run or not self.verify_actions:
+            self.click(None if in_place else position)
+            return True
+
+        # 先把鼠标移到按钮上再截基准，按钮的悬停高亮不会被当成购买结果
+        if not in_place:
+            self.move_to(position)
+        ranges = self.outcome_ranges(is_convertible, min_quantity)
+        if baseline is None:
+            baseline = self.capture_ranges(ranges)
+        self.click(None)
+        changed, elapsed = wait_regions_change(
+            ranges,
+            baseline,
+            timeout=self.verify_timeout,
+            method=self.screenshot_method,
+        )
+        self.metrics.observe("verify", elapsed)
+        if changed:
+            self.metrics.incr("verify_ok")
+            return True
+        self.metrics.incr("verify_fail")
+        print("点击后购买结果区域没有变化，无法确认是否买到")
+        return False
+
+    def _record_bought(self, units):
+        if self.dry_run:
+            return
+        self.units_bought += units
+        self.metrics.incr("units_bought", units)
+
     def buy(self, is_convertible):
         """
         执行购买操作
         is_convertible: 是否可兑换
+        返回是否确认购买成功
         """
+        self.metrics.incr("buys")
         if is_convertible:
             # 点击最大购买量
-            mouse_click(self.postion_isconvertible_max_shopping_number)
+            self.click(self.postion_isconvertible_max_shopping_number)
             # 点击购买按钮
-            mouse_click(self.postion_isconvertible_buy_button)
+            ok = self.click_verified(
+                self.postion_isconvertible_buy_button, is_convertible=True
+            )
         else:
             # 不可兑换时正常操作
-            mouse_click(self.postion_notconvertiable_max_shopping_number)
-            mouse_click(self.postion_notconvertiable_buy_button)
+            self.click(self.postion_notconvertiable_max_shopping_number)
+            ok = self.click_verified(
+                self.postion_notconvertiable_buy_button, is_convertible=False
+            )
+        if ok:
+            self._record_bought(self.max_shopping_number)
+        return ok
+
+    def buy_in_place(self, position, is_convertible=False, baseline=None):
+        """
+        鼠标已经停在购买按钮上时原地点击，买1个
+        position: 购买按钮位置
+        baseline: 鼠标移到按钮上之后截好的购买结果区域
+        返回是否确认购买成功
+        """
+        self.metrics.incr("buys")
+        ok = self.click_verified(
+            position,
+            is_convertible=is_convertible,
+            baseline=baseline,
+            in_place=True,
+            min_quantity=True,
+        )
+        if ok:
+            self._record_bought(1)
+        return ok
 
     def refresh(self, is_convertible):
+        """
+        买1个来刷新价格
+        返回是否确认购买成功
+        """
+        self.metrics.incr("refreshes")
         positions = (
             (
                 self.postion_isconvertible_min_shopping_number,
@@ -301,14 +682,20 @@ class BuyBot:
                 self.postion_notconvertiable_buy_button,
             )
         )
-        mouse_click(positions[0])
-        mouse_click(positions[1])
+        self.click(positions[0])
+        ok = self.click_verified(
+            positions[1], is_convertible=is_convertible, min_quantity=True
+        )
+        if ok:
+            self._record_bought(1)
+        return ok
 
     def freerefresh(self, good_postion):
+        self.metrics.incr("free_refreshes")
         # esc回到商店页面
-        pyautogui.press("esc")
+        self.press("esc")
         # 点击回到商品页面
-        mouse_click(good_postion)
+        self.click(good_postion)
 
 
 def main():
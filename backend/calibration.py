@@ -0,0 +1,446 @@
+"""
+布局校准工具：根据一张商品页面的全屏截图推算价格区域和按钮位置
+
+BuyBot中的默认坐标是按2560x1440整理的屏幕比例，在其他分辨率、UI缩放或
+宽高比下会失效。在需要校准的机器上打开商品页面，运行
+    python -m backend.calibration
+用OCR在截图中找到购买按钮上的"购买"和最低价的数字，缩放按16:9居中推算，
+以它们在默认布局中的位置为参照求出平移，应用到整个布局，不需要参考机器。
+再用OCR从截图中试读一次价格验证，通过后才写入 layout.json。
+
+有2560x1440的机器时也可以先在其上运行 --save-templates 保存按钮模板到
+templates/ 目录，之后的校准优先用模板匹配，找不到模板时再用OCR定位。
+启动时BuyBot直接读取 layout.json，只需要几毫秒。
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from backend.utils import get_screenshot, to_pixel_range
+from backend.BuyBot import BuyBot
+
+# 默认布局对应的参考分辨率
+REFERENCE_SIZE = (2560, 1440)
+
+# 模板匹配的最低相关系数，低于此值认为没找到
+MIN_MATCH_SCORE = 0.7
+
+# 按钮模板在参考分辨率下的半宽和半高（像素）
+TEMPLATE_HALF_SIZE = (60, 18)
+
+# OCR定位时购买按钮上的文字
+BUY_BUTTON_TEXT = "购买"
+
+# 匹配点在参考分辨率下至少相距这么多像素才拟合缩放，
+# 距离太近时几像素的定位误差就会被放大成明显的缩放误差
+MIN_SCALE_SPREAD = 200
+
+
+def to_gray(img_np):
+    return img_np[:, :, :3].astype(np.float32).mean(axis=2)
+
+
+def match_template(image, template):
+    """
+    归一化互相关模板匹配（FFT实现），image和template为灰度图
+    返回 (左上角x, 左上角y, 相关系数)
+    """
+    ih, iw = image.shape
+    th, tw = template.shape
+    if th > ih or tw > iw:
+        return 0, 0, -1.0
+
+    t = template - template.mean()
+    t_norm = np.sqrt(np.sum(t * t))
+    if t_norm == 0:
+        return 0, 0, -1.0
+
+    # 互相关
+    shape = (ih + th - 1, iw + tw - 1)
+    corr = np.fft.irfft2(
+        np.fft.rfft2(image, shape) * np.fft.rfft2(t[::-1, ::-1], shape), shape
+    )[th - 1 : ih, tw - 1 : iw]
+
+    # 用积分图计算每个窗口的方差
+    def window_sum(a):
+        integral = np.pad(a, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+        return (
+            integral[th:, tw:]
+            - integral[:-th, tw:]
+            - integral[th:, :-tw]
+            + integral[:-th, :-tw]
+        )
+
+    n = th * tw
+    local_sum = window_sum(image.astype(np.float64))
+    local_sq = window_sum(image.astype(np.float64) ** 2)
+    variance = np.maximum(local_sq - local_sum * local_sum / n, 0)
+    ncc = corr / (np.sqrt(variance) * t_norm + 1e-6)
+
+    y, x = np.unravel_index(np.argmax(ncc), ncc.shape)
+    return int(x), int(y), float(ncc[y, x])
+
+
+def guess_layout(layout, screen_w, screen_h):
+    """
+    初始猜测：假设游戏界面保持16:9并居中（超宽屏左右留黑边，4:3上下留黑边）
+    把2560x1440下的屏幕比例映射到当前屏幕
+    返回 (布局, 缩放, x偏移, y偏移)，缩放和偏移用于像素坐标换算
+    """
+    ref_w, ref_h = REFERENCE_SIZE
+    scale = min(screen_w / ref_w, screen_h / ref_h)
+    offset_x = (screen_w - ref_w * scale) / 2
+    offset_y = (screen_h - ref_h * scale) / 2
+    return (
+        transform_layout(layout, scale, offset_x, offset_y, screen_w, screen_h),
+        scale,
+        offset_x,
+        offset_y,
+    )
+
+
+def transform_layout(layout, scale, offset_x, offset_y, screen_w, screen_h):
+    """
+    把参考分辨率下的屏幕比例布局，按 像素 = 参考像素*scale + offset 变换到当前屏幕
+    """
+    ref_w, ref_h = REFERENCE_SIZE
+    result = {}
+    for key, values in layout.items():
+        converted = []
+        for i, value in enumerate(values):
+            if i % 2 == 0:
+                converted.append((value * ref_w * scale + offset_x) / screen_w)
+            else:
+                converted.append((value * ref_h * scale + offset_y) / screen_h)
+        result[key] = converted
+    return result
+
+
+def template_box(position, screen_w, screen_h, scale=1.0):
+    """按钮中心附近的模板区域（像素），返回 [left, top, right, bottom]"""
+    cx = position[0] * screen_w
+    cy = position[1] * screen_h
+    half_w = TEMPLATE_HALF_SIZE[0] * scale
+    half_h = TEMPLATE_HALF_SIZE[1] * scale
+    return [
+        int(round(cx - half_w)),
+        int(round(cy - half_h)),
+        int(round(cx + half_w)),
+        int(round(cy + half_h)),
+    ]
+
+
+def save_templates(screenshot, layout, templates_dir="templates"):
+    """
+    在参考分辨率下，按当前布局从截图中裁出各按钮模板
+    只有"postion_"开头的按钮位置会保存模板，价格区域内容会变化不适合做模板
+    """
+    screen_h, screen_w = screenshot.shape[:2]
+    if (screen_w, screen_h) != REFERENCE_SIZE:
+        print(
+            f"警告: 当前截图为 {screen_w}x{screen_h}，"
+            f"模板应在 {REFERENCE_SIZE[0]}x{REFERENCE_SIZE[1]} 下保存"
+        )
+    os.makedirs(templates_dir, exist_ok=True)
+    saved = []
+    for key, position in layout.items():
+        if not key.startswith("postion_"):
+            continue
+        left, top, right, bottom = template_box(position, screen_w, screen_h)
+        crop = screenshot[top:bottom, left:right, :3]
+        Image.fromarray(np.ascontiguousarray(crop)).save(
+            os.path.join(templates_dir, f"{key}.png")
+        )
+        saved.append(key)
+    print(f"已保存 {len(saved)} 个模板到 {templates_dir}")
+    return saved
+
+
+def find_templates(screenshot, layout, templates_dir="templates", search_margin=0.1):
+    """
+    在截图中查找各按钮模板
+    以初始猜测为中心，在search_margin（屏幕比例）范围内、几种缩放下搜索
+    返回 {布局键: (参考像素x, 参考像素y, 找到的像素x, 找到的像素y, 相关系数)}
+    """
+    screen_h, screen_w = screenshot.shape[:2]
+    gray = to_gray(screenshot)
+    guessed, scale, _, _ = guess_layout(layout, screen_w, screen_h)
+    ref_w, ref_h = REFERENCE_SIZE
+
+    matches = {}
+    for key, position in layout.items():
+        path = os.path.join(templates_dir, f"{key}.png")
+        if not key.startswith("postion_") or not os.path.exists(path):
+            continue
+        template_img = Image.open(path).convert("RGB")
+
+        # 搜索窗口
+        cx = guessed[key][0] * screen_w
+        cy = guessed[key][1] * screen_h
+        margin_x = search_margin * screen_w
+        margin_y = search_margin * screen_h
+        left = int(max(cx - margin_x, 0))
+        top = int(max(cy - margin_y, 0))
+        right = int(min(cx + margin_x, screen_w))
+        bottom = int(min(cy + margin_y, screen_h))
+        window = gray[top:bottom, left:right]
+
+        best = None
+        for factor in [0.9, 1.0, 1.1]:
+            s = scale * factor
+            size = (
+                max(int(round(template_img.width * s)), 4),
+                max(int(round(template_img.height * s)), 4),
+            )
+            template = to_gray(np.asarray(template_img.resize(size, Image.BILINEAR)))
+            x, y, score = match_template(window, template)
+            if best is None or score > best[2]:
+                best = (left + x + size[0] / 2, top + y + size[1] / 2, score)
+
+        if best[2] < MIN_MATCH_SCORE:
+            print(f"{key}: 未找到（相关系数 {best[2]:.2f}）")
+            continue
+        print(f"{key}: 找到 ({best[0]:.0f}, {best[1]:.0f})，相关系数 {best[2]:.2f}")
+        matches[key] = (
+            position[0] * ref_w,
+            position[1] * ref_h,
+            best[0],
+            best[1],
+            best[2],
+        )
+    return matches
+
+
+def search_window(position, screen_w, screen_h, margin):
+    """以屏幕比例坐标为中心、margin为半径的搜索窗口（像素），返回 [left, top, right, bottom]"""
+    cx = position[0] * screen_w
+    cy = position[1] * screen_h
+    return [
+        int(max(cx - margin * screen_w, 0)),
+        int(max(cy - margin * screen_h, 0)),
+        int(min(cx + margin * screen_w, screen_w)),
+        int(min(cy + margin * screen_h, screen_h)),
+    ]
+
+
+def find_text_anchors(screenshot, layout, reader, is_convertible, search_margin=0.1):
+    """
+    不依赖模板，用OCR找到购买按钮上的文字和最低价的数字作为定位点
+    只在初始猜测附近的窗口内识别，避免对整张截图跑OCR
+    返回格式与find_templates相同
+    """
+    screen_h, screen_w = screenshot.shape[:2]
+    guessed, _, _, _ = guess_layout(layout, screen_w, screen_h)
+    ref_w, ref_h = REFERENCE_SIZE
+    if is_convertible:
+        button_key = "postion_isconvertible_buy_button"
+        price_key = "range_isconvertible_lowest_price"
+    else:
+        button_key = "postion_notconvertiable_buy_button"
+        price_key = "range_notconvertible_lowest_price"
+
+    def price_center(values):
+        return [(values[0] + values[2]) / 2, (values[1] + values[3]) / 2]
+
+    anchors = [
+        (button_key, layout[button_key], guessed[button_key], lambda t: BUY_BUTTON_TEXT in t),
+        (
+            price_key,
+            price_center(layout[price_key]),
+            price_center(guessed[price_key]),
+            lambda t: any(c.isdigit() for c in t),
+        ),
+    ]
+    matches = {}
+    for key, reference, guess, accept in anchors:
+        left, top, right, bottom = search_window(guess, screen_w, screen_h, search_margin)
+        window = np.ascontiguousarray(screenshot[top:bottom, left:right, :3])
+        # 取离初始猜测最近的候选
+        best = None
+        for box, text, conf in reader.readtext(window):
+            if not accept(str(text)):
+                continue
+            x = left + sum(point[0] for point in box) / len(box)
+            y = top + sum(point[1] for point in box) / len(box)
+            distance = (x - guess[0] * screen_w) ** 2 + (y - guess[1] * screen_h) ** 2
+            if best is None or distance < best[3]:
+                best = (x, y, float(conf), distance, text)
+        if best is None:
+            print(f"{key}: OCR未找到定位文字")
+            continue
+        print(f"{key}: OCR找到 '{best[4]}' ({best[0]:.0f}, {best[1]:.0f})")
+        matches[key] = (
+            reference[0] * ref_w,
+            reference[1] * ref_h,
+            best[0],
+            best[1],
+            best[2],
+        )
+    return matches
+
+
+def fit_transform(matches, default_scale, fit_scale=True):
+    """
+    用匹配结果拟合 像素 = 参考像素*scale + offset
+    匹配点相距至少MIN_SCALE_SPREAD时用最小二乘同时求缩放和偏移，
+    否则（或fit_scale为False时）沿用默认缩放，只求偏移
+    """
+    points = list(matches.values())
+    ref = np.array([[p[0], p[1]] for p in points])
+    found = np.array([[p[2], p[3]] for p in points])
+
+    spread = np.ptp(ref, axis=0).max() if len(points) >= 2 else 0
+    if fit_scale and spread >= MIN_SCALE_SPREAD:
+        # x和y共用缩放，分别有偏移：未知数 [scale, offset_x, offset_y]
+        a = np.zeros((len(points) * 2, 3))
+        a[0::2, 0] = ref[:, 0]
+        a[0::2, 1] = 1
+        a[1::2, 0] = ref[:, 1]
+        a[1::2, 2] = 1
+        b = found.reshape(-1)
+        (scale, offset_x, offset_y), *_ = np.linalg.lstsq(a, b, rcond=None)
+    else:
+        scale = default_scale
+        offset_x, offset_y = (found - ref * scale).mean(axis=0)
+    return float(scale), float(offset_x), float(offset_y)
+
+
+def calibrate(screenshot, layout, templates_dir="templates", reader=None, is_convertible=True):
+    """
+    根据截图推算布局，返回 (布局, 说明信息)
+    优先用按钮模板匹配；没有模板时用OCR找定位文字（需要reader）；
+    都找不到时退回到16:9居中的初始猜测
+    """
+    screen_h, screen_w = screenshot.shape[:2]
+    guessed, scale, offset_x, offset_y = guess_layout(layout, screen_w, screen_h)
+    method = "template"
+    matches = {}
+    if os.path.isdir(templates_dir):
+        matches = find_templates(screenshot, layout, templates_dir)
+    if not matches and reader is not None:
+        method = "ocr"
+        matches = find_text_anchors(screenshot, layout, reader, is_convertible)
+    if not matches:
+        print("没有找到任何定位点，使用16:9居中的初始猜测")
+        return guessed, {"method": "guess", "scale": scale}
+
+    # OCR定位点只有购买按钮和价格两处，相距很近，价格数字又是对齐排版而不是居中，
+    # 用来求缩放误差太大，只求偏移，缩放沿用16:9居中的初始猜测
+    scale, offset_x, offset_y = fit_transform(
+        matches, scale, fit_scale=method == "template"
+    )
+    print(f"拟合结果: 缩放 {scale:.4f}，偏移 ({offset_x:.1f}, {offset_y:.1f})")
+    calibrated = transform_layout(
+        layout, scale, offset_x, offset_y, screen_w, screen_h
+    )
+    return calibrated, {
+        "method": method,
+        "scale": scale,
+        "offset": [offset_x, offset_y],
+        "matched": sorted(matches),
+    }
+
+
+def validate_layout(screenshot, layout, bot, is_convertible):
+    """按新布局从截图中裁出价格区域并用OCR试读，读到价格说明价格区域正确"""
+    screen_h, screen_w = screenshot.shape[:2]
+    key = (
+        "range_isconvertible_lowest_price"
+        if is_convertible
+        else "range_notconvertible_lowest_price"
+    )
+    left, top, right, bottom = to_pixel_range(layout[key], screen_w, screen_h)
+    crop = np.ascontiguousarray(screenshot[top:bottom, left:right, :3])
+    if crop.size == 0:
+        print("验证失败：价格区域超出截图范围")
+        return False
+    price, _ = bot.extract_price(bot.reader.readtext(crop))
+    if price is None:
+        Image.fromarray(crop).save("calibration_price.png")
+        print("验证失败：没有读到价格，请检查calibration_price.png")
+        return False
+    print(f"验证通过：读到价格 {price}")
+    return True
+
+
+def save_layout(path, layout, screen_w, screen_h, info):
+    """先写临时文件再替换，BuyBot启动时不会读到写了一半的布局"""
+    profile = {
+        "screen": [screen_w, screen_h],
+        "created_at": time.time(),
+        "calibration": info,
+        "layout": layout,
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    print(f"布局已写入 {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DFMarketBot 布局校准")
+    parser.add_argument(
+        "--save-templates",
+        action="store_true",
+        help="在2560x1440下按默认布局保存按钮模板",
+    )
+    parser.add_argument("--templates-dir", default="templates")
+    parser.add_argument("--output", default="layout.json")
+    parser.add_argument("--screenshot", help="使用已保存的截图文件而不是现场截图")
+    parser.add_argument(
+        "--convertible",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="当前商品页面是否为可兑换物品，用于验证价格区域",
+    )
+    parser.add_argument("--screenshot-method", default="mss")
+    args = parser.parse_args()
+
+    if args.screenshot:
+        screenshot = np.asarray(Image.open(args.screenshot).convert("RGB"))
+    else:
+        print("3秒后截图，请切换到游戏的商品页面")
+        time.sleep(3)
+        screenshot = get_screenshot(method=args.screenshot_method)
+
+    # 默认坐标不受已有layout.json影响
+    bot = BuyBot(
+        load_ocr=False,
+        screenshot_method=args.screenshot_method,
+        layout_path=None,
+        ocr_cache_size=0,
+    )
+    default_layout = bot.layout()
+
+    if args.save_templates:
+        save_templates(screenshot, default_layout, args.templates_dir)
+        return 0
+
+    bot.load_ocr()
+    screen_h, screen_w = screenshot.shape[:2]
+    layout, info = calibrate(
+        screenshot,
+        default_layout,
+        args.templates_dir,
+        reader=bot.reader,
+        is_convertible=args.convertible,
+    )
+    # 购买提示的位置无法从截图推算，不写入布局，由用户确认后手动添加
+    layout.pop("range_purchase_toast", None)
+    # 验证通过后才写入，未通过的布局不会在下次启动时被加载
+    if not validate_layout(screenshot, layout, bot, args.convertible):
+        print(f"未写入 {args.output}")
+        return 1
+    save_layout(args.output, layout, screen_w, screen_h, info)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+截图方法基准测试与自动选择
+
+对每种可用的截图方法连续截取N次价格区域，统计耗时，并检查截图尺寸是否正确、
+是否几乎全黑（与get_screenshot_mss_debug_monitors相同的判断），
+选出最快的正确方法并保存到 capture_backend.json。
+
+BuyBot使用 screenshot_method="auto" 时读取保存的结果，没有结果时在启动时现场测试。
+离线跑基准（Linux下可用synthetic合成截图）:
+    python -m backend.capture_bench --methods synthetic --n 500
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from backend.utils import (
+    RegionWatcher,
+    SCREENSHOT_METHODS,
+    SYNTHETIC_SCREEN_SIZE,
+    get_windowshot,
+    get_windowshot_dxgi,
+    to_pixel_range,
+)
+
+# 默认测试区域：可兑换物品的价格区域
+DEFAULT_RANGE = [2179 / 2560, 1078 / 1440, 2308 / 2560, 1102 / 1440]
+
+# 参与自动选择的方法，synthetic和replay不是真实屏幕，只用于离线基准
+AUTO_METHODS = ["mss", "win32", "dxgi"]
+
+# 平均亮度低于该值视为全黑截图
+BLACK_THRESHOLD = 5
+
+
+def expected_size(method, region):
+    if method == "synthetic":
+        left, top, right, bottom = to_pixel_range(region, *SYNTHETIC_SCREEN_SIZE)
+    elif method == "replay":
+        return None  # 回放帧尺寸不定，不检查
+    else:
+        left, top, right, bottom = to_pixel_range(region)
+    return bottom - top, right - left
+
+
+def bench_method(method, region=DEFAULT_RANGE, n=50, warmup=3, max_seconds=5.0):
+    """
+    测试一种截图方法
+    dxgi在画面没有变化时直接返回缓存的帧，只统计真正拿到新帧的截图耗时，
+    max_seconds内新帧不足n张（画面静止）时视为无法测出，不参与自动选择
+    返回 {"method", "ok", "error", "mean_ms", "p50_ms", "p95_ms", "black_frames"}
+    """
+    result = {"method": method, "ok": False, "error": None}
+    try:
+        for _ in range(warmup):
+            get_windowshot(region, method=method)
+
+        size = expected_size(method, region)
+        timings = []
+        black_frames = 0
+        deadline = time.perf_counter() + max_seconds
+        while len(timings) < n:
+            if time.perf_counter() > deadline:
+                raise RuntimeError(
+                    f"{max_seconds}秒内只拿到 {len(timings)} 张新帧，画面静止时无法测出真实耗时"
+                )
+            start = time.perf_counter()
+            img = get_windowshot(region, method=method)
+            elapsed = time.perf_counter() - start
+            if img is None:
+                raise RuntimeError("截图返回None")
+            if method == "dxgi" and not get_windowshot_dxgi.fresh:
+                time.sleep(0.001)
+                continue
+            timings.append(elapsed)
+            if size is not None and img.shape[:2] != size:
+                raise RuntimeError(f"截图尺寸 {img.shape[:2]} 与预期 {size} 不符")
+            if np.mean(img) < BLACK_THRESHOLD:
+                black_frames += 1
+    except Exception as e:
+        # 缺少依赖（如dxcam、win32）或截图失败
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    timings = np.array(timings) * 1000
+    result.update(
+        {
+            "ok": black_frames == 0,
+            "mean_ms": float(timings.mean()),
+            "p50_ms": float(np.percentile(timings, 50)),
+            "p95_ms": float(np.percentile(timings, 95)),
+            "black_frames": black_frames,
+        }
+    )
+    if black_frames:
+        result["error"] = f"{black_frames}/{n} 张截图几乎全黑"
+    return result
+
+
+def run_benchmark(methods=None, region=DEFAULT_RANGE, n=50):
+    """测试多种方法，返回结果列表，正确的在前并按平均耗时排序"""
+    if methods is None:
+        methods = AUTO_METHODS
+    results = [bench_method(method, region=region, n=n) for method in methods]
+    results.sort(key=lambda r: (not r["ok"], r.get("mean_ms", float("inf"))))
+    return results
+
+
+def print_results(results):
+    print(f"{'方法':<10} {'平均ms':>8} {'p50ms':>8} {'p95ms':>8}  状态")
+    for r in results:
+        if "mean_ms" in r:
+            print(
+                f"{r['method']:<10} {r['mean_ms']:>8.2f} {r['p50_ms']:>8.2f} "
+                f"{r['p95_ms']:>8.2f}  {'正常' if r['ok'] else r['error']}"
+            )
+        else:
+            print(f"{r['method']:<10} {'-':>8} {'-':>8} {'-':>8}  {r['error']}")
+
+
+def watch_cost(methods, region=DEFAULT_RANGE, rates=(50, 100, 200), seconds=2.0):
+    """测试RegionWatcher在不同采样频率下的开销"""
+    print(f"{'方法':<10} {'目标Hz':>7} {'实际Hz':>8} {'单次ms':>8} {'CPU%':>7}")
+    results = []
+    for method in methods:
+        watcher = RegionWatcher(region, method=method)
+        for rate in rates:
+            try:
+                cost = watcher.measure_cost(rate_hz=rate, seconds=seconds)
+            except Exception as e:
+                print(f"{method:<10} {rate:>7} 测试失败: {type(e).__name__}: {e}")
+                break
+            cost["method"] = method
+            results.append(cost)
+            print(
+                f"{method:<10} {rate:>7} {cost['achieved_hz']:>8.1f} "
+                f"{cost['sample_ms']:>8.3f} {cost['cpu_percent']:>7.1f}"
+            )
+    return results
+
+
+def save_choice(path, results):
+    best = next((r for r in results if r["ok"]), None)
+    data = {
+        "method": best["method"] if best else None,
+        "created_at": time.time(),
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    return data["method"]
+
+
+def choose_backend(path="capture_backend.json", n=20, refresh=False):
+    """
+    返回最快的正确截图方法
+    有保存的结果时直接读取，否则现场测试并保存；都不可用时退回mss
+    """
+    if not refresh and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            method = json.load(f).get("method")
+        if method in SCREENSHOT_METHODS:
+            return method
+
+    print("正在测试截图方法...")
+    results = run_benchmark(AUTO_METHODS, n=n)
+    print_results(results)
+    method = save_choice(path, results)
+    if method is None:
+        print("没有可用的截图方法，使用默认的mss")
+        return "mss"
+    print(f"选择截图方法: {method}")
+    return method
+
+
+def main():
+    parser = argparse.ArgumentParser(description="截图方法基准测试")
+    parser.add_argument(
+        "--methods", nargs="+", default=AUTO_METHODS, choices=SCREENSHOT_METHODS
+    )
+    parser.add_argument("--n", type=int, default=200, help="每种方法的截图次数")
+    parser.add_argument(
+        "--region", type=float, nargs=4, default=DEFAULT_RANGE, help="截图范围"
+    )
+    parser.add_argument("--save", help="把选择结果保存到该文件，如capture_backend.json")
+    parser.add_argument("--replay-dir", help="测试replay方法时使用的截图目录")
+    parser.add_argument(
+        "--watch-rates",
+        type=int,
+        nargs="+",
+        help="额外测试RegionWatcher在这些采样频率(Hz)下的CPU开销",
+    )
+    args = parser.parse_args()
+
+    if args.replay_dir:
+        from backend.utils import set_replay_frames
+
+        set_replay_frames(args.replay_dir)
+
+    results = run_benchmark(args.methods, region=args.region, n=args.n)
+    print_results(results)
+    if args.save:
+        method = save_choice(args.save, results)
+        print(f"已保存选择结果: {method}")
+    if args.watch_rates:
+        ok_methods = [r["method"] for r in results if r["ok"]]
+        watch_cost(ok_methods, region=args.region, rates=args.watch_rates)
+    return 0 if any(r["ok"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,391 @@
+"""
+多实例协调器：多个账号的机器人实例注册到同一个协调器
+
+- 共享各物品最近的价格观测
+- 分配盯价任务：同一物品只由一个实例轮询，其他实例待命，
+  共享价格低于理想价格时才自己读价购买
+- 可选的集中OCR：同一台机器上的实例把截图发给协调器识别，只加载一份模型
+
+启动协调器:
+    python -m backend.coordinator --port 8770 --ocr
+实例（无界面模式）通过 --coordinator 127.0.0.1:8770 连接
+
+协议：TCP长连接，每行一个JSON请求，每行一个JSON响应
+"""
+
+import argparse
+import base64
+import json
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# 实例超过该时间（秒）没有心跳视为下线，其任务重新分配
+INSTANCE_TIMEOUT = 10.0
+# 客户端心跳间隔（秒）
+HEARTBEAT_INTERVAL = 2.0
+
+
+class Coordinator:
+    """协调器状态，与网络无关，便于直接测试"""
+
+    def __init__(self, ocr_engine=None, history=50):
+        self.ocr_engine = ocr_engine
+        self.history = history
+        self._lock = threading.Lock()
+        self.instances = {}  # 实例 -> {"items": set, "last_seen": 时间}
+        self.assignments = {}  # 物品 -> 实例
+        self.observations = {}  # 物品 -> deque[(时间, 价格, 实例)]
+        self._reader = None
+        self._ocr_lock = threading.Lock()
+
+    def register(self, instance, items):
+        with self._lock:
+            self.instances[instance] = {"items": set(items), "last_seen": time.time()}
+            self._rebalance()
+            return self._assigned_to(instance)
+
+    def unregister(self, instance):
+        with self._lock:
+            self.instances.pop(instance, None)
+            self._rebalance()
+
+    def heartbeat(self, instance):
+        with self._lock:
+            entry = self.instances.get(instance)
+            if entry is None:
+                return None  # 需要重新注册
+            entry["last_seen"] = time.time()
+            self._expire()
+            return self._assigned_to(instance)
+
+    def report(self, instance, item, price):
+        with self._lock:
+            history = self.observations.get(item)
+            if history is None:
+                history = self.observations[item] = deque(maxlen=self.history)
+            history.append((time.time(), price, instance))
+
+    def recent(self, item, max_age=None):
+        """物品最近的观测，从旧到新"""
+        now = time.time()
+        with self._lock:
+            history = list(self.observations.get(item, ()))
+        return [
+            {"time": t, "price": price, "instance": instance}
+            for t, price, instance in history
+            if max_age is None or now - t <= max_age
+        ]
+
+    def load_ocr(self):
+        """加载集中OCR的模型，serve()在接受连接前调用，避免首个OCR请求等待加载超时"""
+        if self.ocr_engine is None:
+            raise RuntimeError("协调器未启用集中OCR")
+        with self._ocr_lock:
+            if self._reader is None:
+                import easyocr
+
+                self._reader = easyocr.Reader(["ch_sim", "en"], gpu=False)
+
+    def ocr(self, img_np):
+        """集中OCR，返回与easyocr.readtext相同结构的结果（坐标转为列表）"""
+        self.load_ocr()
+        with self._ocr_lock:
+            results = self._reader.readtext(img_np)
+        return [
+            [[[float(v) for v in point] for point in box], text, float(conf)]
+            for box, text, conf in results
+        ]
+
+    def _assigned_to(self, instance):
+        return sorted(
+            item for item, owner in self.assignments.items() if owner == instance
+        )
+
+    def _expire(self):
+        now = time.time()
+        expired = [
+            instance
+            for instance, entry in self.instances.items()
+            if now - entry["last_seen"] > INSTANCE_TIMEOUT
+        ]
+        for instance in expired:
+            print(f"实例 {instance} 超时下线")
+            del self.instances[instance]
+        if expired:
+            self._rebalance()
+
+    def _rebalance(self):
+        """每个物品分给关注它的实例中当前任务最少的一个，尽量保持原分配"""
+        load = dict.fromkeys(self.instances, 0)
+        assignments = {}
+        all_items = sorted(
+            {item for entry in self.instances.values() for item in entry["items"]}
+        )
+        # 先保留仍然有效的原分配，但每个实例不超过平均份额，新实例加入后能分到任务
+        cap = -(-len(all_items) // max(len(self.instances), 1))
+        for item in all_items:
+            owner = self.assignments.get(item)
+            if (
+                owner in self.instances
+                and item in self.instances[owner]["items"]
+                and load[owner] < cap
+            ):
+                assignments[item] = owner
+                load[owner] += 1
+        for item in all_items:
+            if item in assignments:
+                continue
+            candidates = sorted(
+                instance
+                for instance, entry in self.instances.items()
+                if item in entry["items"]
+            )
+            owner = min(candidates, key=lambda instance: load[instance])
+            assignments[item] = owner
+            load[owner] += 1
+        self.assignments = assignments
+
+    def handle(self, request):
+        """处理一条请求，返回响应"""
+        cmd = request.get("cmd")
+        if cmd == "register":
+            assigned = self.register(request["instance"], request.get("items", []))
+            return {"ok": True, "assigned": assigned}
+        if cmd == "heartbeat":
+            assigned = self.heartbeat(request["instance"])
+            if assigned is None:
+                return {"ok": False, "error": "unregistered"}
+            return {"ok": True, "assigned": assigned}
+        if cmd == "unregister":
+            self.unregister(request["instance"])
+            return {"ok": True}
+        if cmd == "report":
+            self.report(request["instance"], request["item"], request["price"])
+            return {"ok": True}
+        if cmd == "recent":
+            return {
+                "ok": True,
+                "observations": self.recent(request["item"], request.get("max_age")),
+            }
+        if cmd == "ocr":
+            img = np.frombuffer(
+                base64.b64decode(request["data"]), dtype=np.uint8
+            ).reshape(request["shape"])
+            return {"ok": True, "results": self.ocr(img)}
+        return {"ok": False, "error": f"未知命令: {cmd}"}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    coordinator = None
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.coordinator.handle(json.loads(line))
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+def serve(host="127.0.0.1", port=8770, ocr_engine=None):
+    """启动协调器服务，返回 (server, coordinator)，服务在守护线程中运行"""
+    coordinator = Coordinator(ocr_engine=ocr_engine)
+    if ocr_engine is not None:
+        print("正在加载集中OCR模型...")
+        coordinator.load_ocr()
+    handler = type("CoordinatorHandler", (_Handler,), {"coordinator": coordinator})
+    server = socketserver.ThreadingTCPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"协调器已启动: {host}:{port}，集中OCR: {ocr_engine or '未启用'}")
+    return server, coordinator
+
+
+class CoordinatorClient:
+    """
+    机器人实例一侧的客户端
+    后台线程定时心跳并更新分配到的物品；协调器不可达时退回到独立运行
+    timeout: 注册、心跳等控制消息的超时（秒）
+    ocr_timeout: 集中OCR请求的超时（秒），OCR排队和识别比控制消息慢得多
+    """
+
+    def __init__(self, address, instance, items, timeout=5.0, ocr_timeout=30.0):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.instance = instance
+        self.items = list(items)
+        self.timeout = timeout
+        self.ocr_timeout = ocr_timeout
+        self.assigned = set()
+        self.connected = False
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self._register()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def request(self, payload, timeout=None):
+        """
+        发送一条请求并等待响应，连接断开时自动重连一次
+        超时不重发：协调器可能仍在处理，重发只会让请求排队重复执行
+        timeout: 本次请求的超时，默认为self.timeout
+        """
+        data = (json.dumps(payload) + "\n").encode("utf-8")
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._sock = socket.create_connection(
+                            self.address, timeout=self.timeout
+                        )
+                        self._file = self._sock.makefile("rb")
+                    self._sock.settimeout(timeout or self.timeout)
+                    self._sock.sendall(data)
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError("协调器关闭了连接")
+                    self.connected = True
+                    return json.loads(line)
+                except OSError as e:
+                    self._close()
+                    if attempt == 1 or isinstance(e, socket.timeout):
+                        self.connected = False
+                        raise
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._file = None
+
+    def _register(self):
+        try:
+            response = self.request(
+                {"cmd": "register", "instance": self.instance, "items": self.items}
+            )
+            self.assigned = set(response.get("assigned", []))
+            print(f"已注册到协调器，分配到的物品: {sorted(self.assigned)}")
+        except OSError as e:
+            print(f"无法连接协调器 {self.address}，独立运行: {e}")
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                response = self.request({"cmd": "heartbeat", "instance": self.instance})
+                if response.get("error") == "unregistered":
+                    self._register()
+                else:
+                    self.assigned = set(response.get("assigned", []))
+            except OSError:
+                pass  # 下次心跳再试
+
+    def is_assigned(self, item):
+        """协调器不可达时视为分配给自己，保证不会漏盯"""
+        return not self.connected or item in self.assigned
+
+    def report(self, item, price):
+        try:
+            self.request(
+                {"cmd": "report", "instance": self.instance, "item": item, "price": price}
+            )
+        except OSError:
+            pass
+
+    def latest_price(self, item, max_age=5.0):
+        """其他实例最近观测到的价格，没有时返回None"""
+        try:
+            response = self.request({"cmd": "recent", "item": item, "max_age": max_age})
+        except OSError:
+            return None
+        observations = [
+            o for o in response.get("observations", []) if o["price"] is not None
+        ]
+        return observations[-1]["price"] if observations else None
+
+    def ocr(self, img_np):
+        img_np = np.ascontiguousarray(img_np, dtype=np.uint8)
+        response = self.request(
+            {
+                "cmd": "ocr",
+                "shape": list(img_np.shape),
+                "data": base64.b64encode(img_np.tobytes()).decode("ascii"),
+            },
+            timeout=self.ocr_timeout,
+        )
+        if not response.get("ok"):
+            raise RuntimeError(f"集中OCR失败: {response.get('error')}")
+        return response["results"]
+
+    def close(self):
+        self._stop.set()
+        try:
+            self.request({"cmd": "unregister", "instance": self.instance})
+        except OSError:
+            pass
+        with self._lock:
+            self._close()
+
+
+class RemoteReader:
+    """
+    与easyocr.Reader接口一致的集中OCR读取器，供BuyBot使用
+    local_factory: 返回本地读取器的函数，协调器不可达或集中OCR失败时改用本地读取器，
+                   首次需要时才调用；协调器恢复连接后重新使用集中OCR
+    """
+
+    def __init__(self, client, local_factory=None):
+        self.client = client
+        self.local_factory = local_factory
+        self._local = None
+        self.using_local = False
+
+    def readtext(self, img_np):
+        # 未连接时不必每次都等待连接超时，心跳恢复连接后再使用集中OCR
+        if self.client.connected or self.local_factory is None:
+            try:
+                results = [tuple(result) for result in self.client.ocr(img_np)]
+                if self.using_local:
+                    print("协调器已恢复，重新使用集中OCR")
+                    self.using_local = False
+                return results
+            except (OSError, RuntimeError) as e:
+                if self.local_factory is None:
+                    raise
+                print(f"集中OCR不可用: {e}")
+        if not self.using_local:
+            print("改用本地OCR")
+            self.using_local = True
+        if self._local is None:
+            self._local = self.local_factory()
+        return self._local.readtext(img_np)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DFMarketBot 多实例协调器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8770)
+    parser.add_argument("--ocr", action="store_true", help="启用集中OCR（easyocr）")
+    args = parser.parse_args()
+
+    server, _ = serve(args.host, args.port, ocr_engine="easyocr" if args.ocr else None)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
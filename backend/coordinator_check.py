@@ -0,0 +1,199 @@
+"""
+多实例协调的端到端检查
+
+在本进程内启动协调器（集中OCR）和两个无界面实例，实例使用replay截图方法回放录制的
+全屏截图，dry_run不点击鼠标，不需要游戏:
+    python -m backend.coordinator_check --replay-dir 截图目录
+
+检查项:
+1. 分配：两个实例盯同一物品时只有一个实例读价，另一个待命
+2. 共享价格：协调器只收到读价实例上报的价格
+3. 集中OCR：读价实例由协调器识别，没有退回本地OCR
+4. 故障转移：读价实例退出后，另一个实例在心跳后接手读价
+5. 协调器不可达：实例可以启动并独立运行，集中OCR退回本地OCR
+另外直接检查Coordinator的任务分配，不经过网络
+"""
+
+import argparse
+import socket
+import sys
+import threading
+import time
+
+from backend.BotLoop import BotLoop
+from backend.BuyBot import BuyBot
+from backend.coordinator import HEARTBEAT_INTERVAL, Coordinator, CoordinatorClient, serve
+from backend.utils import set_replay_frames
+
+ITEM = "检查物品"
+# 商品位置，dry_run时只打印
+ITEM_POSITION = [0.5, 0.5]
+
+
+class Instance:
+    """一个无界面实例：协调器客户端 + BuyBot + BotLoop"""
+
+    def __init__(self, address, name):
+        self.name = name
+        self.client = CoordinatorClient(address, name, [ITEM])
+        self.buybot = BuyBot(
+            ocr_engine="remote",
+            ocr_client=self.client,
+            screenshot_method="replay",
+            dry_run=True,
+            ocr_cache_size=0,
+        )
+        self.loop = BotLoop(self.buybot, coordinator=self.client)
+        self.loop.set_item_name(ITEM)
+        # 理想价格为0：待命的实例不会因为共享价格而自己读价
+        self.loop.update_params(0, 0, True, False, 50)
+        self.loop.record_mouse_position(ITEM_POSITION)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.loop.set_running(True)
+
+    def detections(self):
+        """读过价的循环数（不含待命）"""
+        return self.buybot.metrics.snapshot()["counters"]["ocr_calls"]
+
+    def stop(self):
+        self.loop.quit()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.client.close()
+
+
+def check(results, name, ok, detail=""):
+    results.append(ok)
+    print(f"[{'通过' if ok else '失败'}] {name}{'：' + detail if detail else ''}")
+
+
+def check_rebalance(results):
+    coordinator = Coordinator()
+    coordinator.register("a", ["x", "y"])
+    assigned_b = coordinator.register("b", ["x", "y"])
+    check(
+        results,
+        "两个实例平分两个物品",
+        len(assigned_b) == 1 and len(coordinator._assigned_to("a")) == 1,
+        str(coordinator.assignments),
+    )
+    before = dict(coordinator.assignments)
+    coordinator.register("c", ["z"])
+    check(
+        results,
+        "新实例加入不打乱原有分配",
+        all(coordinator.assignments[item] == owner for item, owner in before.items()),
+        str(coordinator.assignments),
+    )
+    coordinator.unregister("a")
+    check(
+        results,
+        "实例下线后其物品转给其他实例",
+        set(coordinator.assignments.values()) == {"b", "c"},
+        str(coordinator.assignments),
+    )
+
+
+def check_instances(results, port, seconds):
+    server, coordinator = serve(port=port, ocr_engine="easyocr")
+    address = f"127.0.0.1:{port}"
+    instances = [Instance(address, "实例1"), Instance(address, "实例2")]
+    try:
+        for instance in instances:
+            instance.start()
+        time.sleep(seconds)
+
+        owner = coordinator.assignments.get(ITEM)
+        polling = [i for i in instances if i.name == owner]
+        standby = [i for i in instances if i.name != owner]
+        check(
+            results,
+            "同一物品只分配给一个实例",
+            len(polling) == 1 and len(standby) == 1,
+            f"分配给 {owner}",
+        )
+        if len(polling) != 1:
+            return
+        polling, standby = polling[0], standby[0]
+        check(
+            results,
+            "只有被分配的实例读价",
+            polling.detections() > 0 and standby.detections() == 0,
+            f"{polling.name} {polling.detections()} 次，{standby.name} {standby.detections()} 次",
+        )
+        check(
+            results,
+            "读价实例使用协调器的集中OCR",
+            not polling.buybot.reader.using_local,
+        )
+        reporters = {o["instance"] for o in coordinator.recent(ITEM)}
+        check(
+            results,
+            "协调器只收到读价实例上报的价格",
+            reporters == {polling.name},
+            str(sorted(reporters)),
+        )
+
+        polling.stop()
+        instances.remove(polling)
+        # 等待待命实例的心跳拿到新的分配
+        time.sleep(HEARTBEAT_INTERVAL * 2 + seconds)
+        check(
+            results,
+            "读价实例退出后另一个实例接手",
+            coordinator.assignments.get(ITEM) == standby.name
+            and standby.detections() > 0
+            and not standby.buybot.reader.using_local,
+            f"分配给 {coordinator.assignments.get(ITEM)}，"
+            f"{standby.name} 读价 {standby.detections()} 次",
+        )
+    finally:
+        for instance in instances:
+            instance.stop()
+        server.shutdown()
+        server.server_close()
+
+
+def check_unreachable(results):
+    # 找一个没有服务监听的端口
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    try:
+        # BuyBot构造时会预热OCR，协调器不可达时不应抛出异常
+        instance = Instance(f"127.0.0.1:{port}", "离线实例")
+        instance.loop.step()
+    except Exception as e:
+        check(results, "协调器不可达时实例仍能启动", False, f"{type(e).__name__}: {e}")
+        return
+    check(
+        results,
+        "协调器不可达时实例独立读价并使用本地OCR",
+        instance.client.is_assigned(ITEM)
+        and instance.detections() > 0
+        and instance.buybot.reader.using_local,
+    )
+    instance.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多实例协调的端到端检查")
+    parser.add_argument("--replay-dir", required=True, help="录制的全屏截图目录")
+    parser.add_argument("--port", type=int, default=8771)
+    parser.add_argument("--seconds", type=float, default=3.0, help="每个阶段的运行时间")
+    args = parser.parse_args()
+
+    set_replay_frames(args.replay_dir)
+    results = []
+    check_rebalance(results)
+    check_instances(results, args.port, args.seconds)
+    check_unreachable(results)
+    print(f"{sum(results)}/{len(results)} 项通过")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
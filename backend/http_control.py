@@ -0,0 +1,89 @@
+"""
+可选的本地HTTP/JSON控制与监控接口
+
+GET  /state            当前运行状态和参数
+GET  /prices?n=50      最近N次识别的价格
+GET  /metrics          计数器和各阶段延迟直方图
+POST /params           更新参数，例如 {"ideal_price": 300}
+POST /start, /stop     开始/停止循环，OCR未就绪或未记录商品位置时/start返回409
+
+服务运行在独立的守护线程中，请求处理只读取BotLoop和Metrics的快照，
+不会占用主循环线程。
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # 由start_http_control在子类上设置
+    loop = None
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/state":
+            self._send_json(self.loop.state())
+        elif url.path == "/prices":
+            query = parse_qs(url.query)
+            try:
+                n = int(query.get("n", ["50"])[0])
+            except ValueError:
+                self._send_json({"error": "n 必须是整数"}, status=400)
+                return
+            self._send_json(self.loop.metrics.last_prices(n))
+        elif url.path == "/metrics":
+            self._send_json(self.loop.metrics.snapshot())
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/start":
+            blocker = self.loop.start_blocker()
+            if blocker is not None:
+                self._send_json({"error": blocker}, status=409)
+                return
+            self.loop.set_running(True)
+            self._send_json(self.loop.state())
+        elif url.path == "/stop":
+            self.loop.set_running(False)
+            self._send_json(self.loop.state())
+        elif url.path == "/params":
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                params = json.loads(self.rfile.read(length) or b"{}")
+                self.loop.set_params(**params)
+            except (ValueError, TypeError) as e:
+                self._send_json({"error": str(e)}, status=400)
+                return
+            self._send_json(self.loop.state())
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def log_message(self, format, *args):
+        # 默认会把每个请求打印到stderr，轮询时太吵
+        pass
+
+
+def start_http_control(loop, port, host="127.0.0.1"):
+    """
+    在守护线程中启动HTTP控制接口，返回server，调用server.shutdown()停止
+    默认只监听本机地址
+    """
+    handler = type("BotLoopHandler", (_Handler,), {"loop": loop})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"HTTP控制接口: http://{host}:{port}/state")
+    return server
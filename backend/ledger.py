@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+import time
+
+
+class SpendLedger:
+    """
+    购买记账：按物品和总计记录买到的数量和花费（数量 × 识别出的价格）
+    总计写入磁盘，重启后继续累计，限额不会因为重启而失效
+    未能确认的购买可能已经成交，按买到计入总计和限额，另外单独统计
+    allows() 只做几次比较，可以在每次循环中调用
+    """
+
+    def __init__(
+        self,
+        path=None,
+        budget=0,
+        max_units=0,
+        item_budget=0,
+        item_max_units=0,
+    ):
+        """
+        path: 持久化文件路径，为None时只在内存中记账
+        budget / max_units: 总花费和总数量上限，0表示不限制
+        item_budget / item_max_units: 单个物品的花费和数量上限，0表示不限制
+        """
+        self.path = path
+        self.budget = budget
+        self.max_units = max_units
+        self.item_budget = item_budget
+        self.item_max_units = item_max_units
+
+        self._lock = threading.Lock()
+        self.total_units = 0
+        self.total_spend = 0
+        self.items = {}  # 物品 -> {"units": 数量, "spend": 花费}
+        # 其中未能确认成交的数量和花费
+        self.unverified_units = 0
+        self.unverified_spend = 0
+        # 本次运行的数量和花费，不持久化
+        self.session_units = 0
+        self.session_spend = 0
+
+        if path is not None:
+            self.load()
+
+    def allows(self, item, units, price):
+        """再买units个单价price的物品是否仍在限额内"""
+        cost = units * price
+        if self.budget and self.total_spend + cost > self.budget:
+            return False
+        if self.max_units and self.total_units + units > self.max_units:
+            return False
+        entry = self.items.get(item)
+        if entry is not None:
+            if self.item_budget and entry["spend"] + cost > self.item_budget:
+                return False
+            if self.item_max_units and entry["units"] + units > self.item_max_units:
+                return False
+        else:
+            if self.item_budget and cost > self.item_budget:
+                return False
+            if self.item_max_units and units > self.item_max_units:
+                return False
+        return True
+
+    def record(self, item, units, price, verified=True):
+        """
+        记录一次购买并保存
+        verified: 是否确认成交，未确认的购买同样计入总计和限额
+        """
+        cost = units * price
+        with self._lock:
+            if not verified:
+                self.unverified_units += units
+                self.unverified_spend += cost
+            entry = self.items.setdefault(item, {"units": 0, "spend": 0})
+            entry["units"] += units
+            entry["spend"] += cost
+            self.total_units += units
+            self.total_spend += cost
+            self.session_units += units
+            self.session_spend += cost
+        print(
+            f"记账: {item} {'买入' if verified else '可能买入（未确认）'} {units} 个，"
+            f"单价 {price}，"
+            f"累计花费 {self.total_spend}，累计数量 {self.total_units}"
+        )
+        self.save()
+
+    def summary(self):
+        with self._lock:
+            return {
+                "total_units": self.total_units,
+                "total_spend": self.total_spend,
+                "session_units": self.session_units,
+                "session_spend": self.session_spend,
+                "unverified_units": self.unverified_units,
+                "unverified_spend": self.unverified_spend,
+                "budget": self.budget,
+                "max_units": self.max_units,
+                "item_budget": self.item_budget,
+                "item_max_units": self.item_max_units,
+                "items": {item: dict(entry) for item, entry in self.items.items()},
+            }
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            # 账本损坏时宁可停下来也不要从0开始，避免限额失效
+            raise RuntimeError(f"账本文件 {self.path} 读取失败: {e}")
+        with self._lock:
+            self.total_units = data.get("total_units", 0)
+            self.total_spend = data.get("total_spend", 0)
+            self.items = data.get("items", {})
+            self.unverified_units = data.get("unverified_units", 0)
+            self.unverified_spend = data.get("unverified_spend", 0)
+        print(f"已加载账本: 累计花费 {self.total_spend}，累计数量 {self.total_units}")
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            data = {
+                "updated_at": time.time(),
+                "total_units": self.total_units,
+                "total_spend": self.total_spend,
+                "items": self.items,
+                "unverified_units": self.unverified_units,
+                "unverified_spend": self.unverified_spend,
+            }
+            # 先写临时文件再替换，避免中途退出导致账本损坏
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"账本保存失败: {e}")
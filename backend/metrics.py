@@ -0,0 +1,130 @@
+import bisect
+import threading
+import time
+from collections import deque
+
+# 延迟直方图的桶上界（毫秒），最后一个桶收集所有更慢的样本
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+COUNTER_NAMES = [
+    "ocr_calls",
+    "cache_hits",
+    "buys",
+    "refreshes",
+    "free_refreshes",
+    "failures",
+    "failure_capture",
+    "failure_ocr_error",
+    "failure_parse",
+    "failure_no_text",
+    "failure_action",
+    "backoffs",
+    "reentries",
+    "debug_dumps",
+    "verify_ok",
+    "verify_fail",
+    "units_bought",
+    "limit_hits",
+    "watch_skips",
+]
+
+
+def percentiles(values, qs=(50, 90, 99)):
+    """返回 {"p50": ..., "p90": ..., "p99": ..., "max": ..., "count": ...}，单位与输入相同"""
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    result = {"count": len(values), "max": values[-1]}
+    for q in qs:
+        index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+        result[f"p{q}"] = values[index]
+    return result
+
+
+class Metrics:
+    """
+    运行指标：计数器、最近N次价格、各阶段延迟直方图
+    记录操作只做O(1)的加法，读取时才复制数据，不会拖慢主循环
+    """
+
+    def __init__(self, price_history=200):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTER_NAMES, 0)
+        self.prices = deque(maxlen=price_history)
+        self.histograms = {}
+        self.started_at = time.time()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_price(self, price):
+        with self._lock:
+            self.prices.append((time.time(), price))
+
+    def observe(self, stage, seconds):
+        """记录一次阶段耗时"""
+        index = bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)
+        with self._lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = {
+                    "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                    "max": 0.0,
+                }
+            hist["buckets"][index] += 1
+            hist["count"] += 1
+            hist["sum"] += seconds
+            if seconds > hist["max"]:
+                hist["max"] = seconds
+
+    def timer(self, stage):
+        """with metrics.timer("ocr"): ... 记录代码块耗时"""
+        return _StageTimer(self, stage)
+
+    def last_prices(self, n=None):
+        with self._lock:
+            prices = list(self.prices)
+        if n is not None:
+            prices = prices[-n:]
+        return [{"time": t, "price": p} for t, p in prices]
+
+    def snapshot(self):
+        """返回可直接序列化为JSON的指标副本"""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {
+                stage: {
+                    "buckets_ms": LATENCY_BUCKETS_MS + ["inf"],
+                    "counts": list(hist["buckets"]),
+                    "count": hist["count"],
+                    "mean_ms": hist["sum"] / hist["count"] * 1000,
+                    "max_ms": hist["max"] * 1000,
+                }
+                for stage, hist in self.histograms.items()
+            }
+        return {
+            "uptime": time.time() - self.started_at,
+            "counters": counters,
+            "latency": histograms,
+        }
+
+
+class _StageTimer:
+    __slots__ = ("metrics", "stage", "start", "elapsed")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.metrics.observe(self.stage, self.elapsed)
+        return False
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class OcrCache:
+    """
+    OCR结果的LRU缓存
+    相同的价格数字渲染出的像素相同，对截图做量化后取哈希作为键，
+    命中时直接返回之前解析出的价格，跳过OCR。
+    与"画面没变就跳过"不同，价格过几分钟回到之前的数值时同样能命中。
+    一次误识别被缓存后会在每次遇到相同画面时重复，因此只缓存置信度足够高的结果，
+    并且条目在ttl秒后过期（包括落盘后重启加载的条目），之后重新OCR。
+    """
+
+    # 文件格式版本，格式或哈希算法变化时递增，旧文件会被忽略
+    VERSION = 2
+
+    def __init__(
+        self,
+        max_size=512,
+        path=None,
+        engine="easyocr",
+        autosave_every=50,
+        min_confidence=0.8,
+        ttl=6 * 3600,
+    ):
+        """
+        max_size: 最多缓存的条目数，超过后淘汰最久未使用的
+        path: 持久化文件路径，为None时不落盘
+        engine: OCR引擎名，持久化文件与引擎不一致时不加载
+        autosave_every: 每新增多少条目自动保存一次
+        min_confidence: 低于该置信度的识别结果不缓存
+        ttl: 条目的有效期（秒），从首次缓存时算起，0表示不过期
+        """
+        self.max_size = max_size
+        self.path = path
+        self.engine = engine
+        self.autosave_every = autosave_every
+        self.min_confidence = min_confidence
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0  # 置信度不足未缓存的次数
+        self.expired = 0
+
+        if path is not None:
+            self.load()
+
+    @staticmethod
+    def key(img_np):
+        """
+        计算截图的紧凑哈希
+        只取一个通道并量化到8级灰度，抵消轻微的抗锯齿和亮度抖动
+        """
+        channel = np.ascontiguousarray(img_np[:, :, 1] >> 5)
+        digest = hashlib.blake2b(channel.tobytes(), digest_size=8)
+        digest.update(np.asarray(channel.shape, dtype=np.int32).tobytes())
+        return digest.hexdigest()
+
+    def _is_expired(self, created_at, now):
+        return bool(self.ttl) and now - created_at > self.ttl
+
+    def get(self, key):
+        """返回 (价格, 置信度)，未命中或已过期返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[2], time.time()):
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, price, confidence):
+        """缓存一次识别结果，置信度低于min_confidence时不缓存，返回是否缓存"""
+        if confidence < self.min_confidence:
+            self.rejected += 1
+            return False
+        with self._lock:
+            self._entries[key] = (price, confidence, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._unsaved += 1
+            should_save = (
+                self.path is not None
+                and self.autosave_every
+                and self._unsaved >= self.autosave_every
+            )
+        if should_save:
+            self.save()
+        return True
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "rejected": self.rejected,
+            "expired": self.expired,
+        }
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"OCR缓存文件读取失败，忽略: {e}")
+            return
+        if data.get("version") != self.VERSION or data.get("engine") != self.engine:
+            print("OCR缓存文件版本或引擎不匹配，忽略")
+            return
+        now = time.time()
+        with self._lock:
+            for key, (price, confidence, created_at) in data.get("entries", [])[
+                -self.max_size :
+            ]:
+                if confidence < self.min_confidence or self._is_expired(created_at, now):
+                    continue
+                self._entries[key] = (price, confidence, created_at)
+        print(f"已加载 {len(self._entries)} 条OCR缓存")
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            entries = [[key, list(value)] for key, value in self._entries.items()]
+            self._unsaved = 0
+        data = {"version": self.VERSION, "engine": self.engine, "entries": entries}
+        # 先写临时文件再替换，避免中途退出导致文件损坏
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"OCR缓存保存失败: {e}")
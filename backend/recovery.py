@@ -0,0 +1,95 @@
+import threading
+
+# 失败类型 -> 恢复方式
+# "retry"   留在当前页面，退避后重新读价
+# "reenter" 重新进入商品页面
+RECOVERY = {
+    "capture": "retry",  # 截图失败多为窗口被遮挡或切换，点击没有帮助
+    "ocr_error": "retry",  # OCR引擎异常，与页面无关
+    "parse": "retry",  # 读到了数字但解析失败，多为页面切换中途，稍后重读即可
+    "no_text": "reenter",  # 价格区域没有数字，多半已不在商品页面或有弹窗
+    "action": "reenter",  # 点击等操作抛出异常，页面状态未知
+}
+
+# 状态
+STATE_OK = "ok"
+STATE_RETRY = "retry"  # 连续失败，退避后重试
+STATE_REENTER = "reenter"  # 本次失败后重新进入商品页面
+STATE_STOPPED = "stopped"  # 连续失败次数达到上限，停止循环
+
+
+class FailureTracker:
+    """
+    循环失败的状态机：按连续失败次数指数退避，按失败类型选择恢复方式
+    成功一次即回到ok状态，退避时间清零
+    base_delay / max_delay: 首次失败的退避时间和退避上限（秒）
+    reenter_after: 每连续失败这么多次，无论失败类型都重新进入一次商品页面
+    stop_after: 连续失败达到该次数后停止循环，0表示不停止
+    """
+
+    def __init__(self, base_delay=0.2, max_delay=10.0, reenter_after=3, stop_after=0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.reenter_after = reenter_after
+        self.stop_after = stop_after
+
+        self._lock = threading.Lock()
+        self.state = STATE_OK
+        self.consecutive = 0
+        self.kinds = {}  # 本轮连续失败中各类型的次数
+        self.last_kind = None
+        self.delay = 0.0
+
+    def failure(self, kind):
+        """
+        记录一次失败，返回恢复计划
+        {"state": 状态, "delay": 退避秒数, "reenter": 是否重新进入页面, "stop": 是否停止}
+        """
+        if kind not in RECOVERY:
+            raise ValueError(f"未知的失败类型: {kind}，仅支持 {list(RECOVERY)}")
+        with self._lock:
+            self.consecutive += 1
+            self.kinds[kind] = self.kinds.get(kind, 0) + 1
+            self.last_kind = kind
+            self.delay = min(
+                self.base_delay * 2 ** (self.consecutive - 1), self.max_delay
+            )
+            stop = bool(self.stop_after) and self.consecutive >= self.stop_after
+            reenter = RECOVERY[kind] == "reenter" or (
+                self.reenter_after > 0 and self.consecutive % self.reenter_after == 0
+            )
+            if stop:
+                self.state = STATE_STOPPED
+            elif reenter:
+                self.state = STATE_REENTER
+            else:
+                self.state = STATE_RETRY
+            return {
+                "state": self.state,
+                "delay": self.delay,
+                "reenter": reenter and not stop,
+                "stop": stop,
+            }
+
+    def success(self):
+        if self.consecutive:
+            print(f"连续失败 {self.consecutive} 次后恢复正常: {self.kinds}")
+        self.reset()
+
+    def reset(self):
+        """回到ok状态，例如重新开始循环时"""
+        with self._lock:
+            self.state = STATE_OK
+            self.consecutive = 0
+            self.kinds = {}
+            self.delay = 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive": self.consecutive,
+                "kinds": dict(self.kinds),
+                "last_kind": self.last_kind,
+                "delay": self.delay,
+            }
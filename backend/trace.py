@@ -0,0 +1,291 @@
+"""
+会话录制与回放
+
+录制：每次循环记录价格区域截图（zlib压缩，或只记哈希）、OCR结果、解析出的价格、
+决策、实际动作和各阶段耗时，写入gzip压缩的JSON行分段文件。
+分段写满后新建下一段，总大小超过上限时删除最旧的分段，磁盘占用有界。
+
+回放：用当前版本的decide()重新决策，可选用当前OCR引擎重新识别录制的截图，
+报告决策和价格不一致的循环，以及OCR耗时相对录制时的退化:
+    python -m backend.trace traces/ --ocr
+"""
+
+import argparse
+import base64
+import glob
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+import zlib
+
+import numpy as np
+
+from backend.BotLoop import decide
+from backend.metrics import percentiles
+
+SEGMENT_PATTERN = "trace-*.jsonl.gz"
+
+
+def crop_hash(img_np):
+    return hashlib.blake2b(
+        np.ascontiguousarray(img_np).tobytes(), digest_size=8
+    ).hexdigest()
+
+
+class TraceRecorder:
+    """
+    滚动写入的会话录制
+    trace_dir: 录制目录
+    max_bytes: 所有分段的总大小上限
+    segment_records: 每个分段的记录数
+    store_crops: 为False时只记录截图哈希，不保存截图本身（无法回放OCR）
+    flush_records / flush_interval: 每写入这么多条或距上次刷新超过这么多秒时刷新到磁盘，
+        程序崩溃或被强制结束时，当前分段中已刷新的记录仍可读取
+    同一分段内相同的截图只保存一次，每个分段可单独读取
+    """
+
+    def __init__(
+        self,
+        trace_dir,
+        max_bytes=50 * 1024 * 1024,
+        segment_records=500,
+        store_crops=True,
+        flush_records=20,
+        flush_interval=5.0,
+    ):
+        self.trace_dir = trace_dir
+        self.max_bytes = max_bytes
+        self.segment_records = segment_records
+        self.store_crops = store_crops
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        os.makedirs(trace_dir, exist_ok=True)
+        self._raw = None
+        self._file = None
+        self._count = 0
+        self._stored = set()  # 当前分段已保存的截图哈希
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def record(self, entry, crop=None):
+        """写入一条记录，crop为本次识别的价格区域截图"""
+        entry = dict(entry)
+        if self._file is None:
+            self._open_segment()
+        if crop is not None:
+            digest = crop_hash(crop)
+            entry["crop_hash"] = digest
+            entry["crop_shape"] = list(crop.shape)
+            if self.store_crops and digest not in self._stored:
+                entry["crop"] = base64.b64encode(
+                    zlib.compress(np.ascontiguousarray(crop, dtype=np.uint8).tobytes(), 1)
+                ).decode("ascii")
+                self._stored.add(digest)
+        self._file.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+        self._count += 1
+        self._unflushed += 1
+        if self._count >= self.segment_records:
+            self._close_segment()
+            self._prune()
+        elif (
+            self._unflushed >= self.flush_records
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """同步刷新gzip流并写入磁盘，之前的记录不必等分段关闭就能读取，没有新记录时什么也不做"""
+        if self._file is not None and self._unflushed:
+            self._file.flush()
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def _open_segment(self):
+        path = os.path.join(self.trace_dir, f"trace-{time.time_ns()}.jsonl.gz")
+        self._raw = open(path, "wb")
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+        self._count = 0
+        self._stored = set()
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._raw.close()
+        self._file = None
+        self._raw = None
+
+    def _prune(self):
+        """总大小超过上限时删除最旧的分段，最新的一段总是保留"""
+        segments = sorted(glob.glob(os.path.join(self.trace_dir, SEGMENT_PATTERN)))
+        sizes = [os.path.getsize(path) for path in segments]
+        total = sum(sizes)
+        for path, size in zip(segments[:-1], sizes[:-1]):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def close(self):
+        self._close_segment()
+        self._prune()
+
+
+def load_trace(trace_dir):
+    """按时间顺序逐条读取录制，有截图时解码到record["crop"]（numpy数组）"""
+    for path in sorted(glob.glob(os.path.join(trace_dir, SEGMENT_PATTERN))):
+        crops = {}
+        try:
+            with gzip.open(path, "rb") as f:
+                for line in f:
+                    record = json.loads(line)
+                    digest = record.get("crop_hash")
+                    if "crop" in record:
+                        crops[digest] = np.frombuffer(
+                            zlib.decompress(base64.b64decode(record["crop"])),
+                            dtype=np.uint8,
+                        ).reshape(record["crop_shape"])
+                    record["crop"] = crops.get(digest)
+                    yield record
+        except (EOFError, OSError, ValueError) as e:
+            # 程序被强制结束时最后一个分段可能不完整
+            print(f"分段 {os.path.basename(path)} 读取中断: {e}")
+
+
+def replay(records, bot=None, tolerance=1.5):
+    """
+    回放录制
+    bot: 提供时用bot.reader重新识别录制的截图并比较价格和OCR耗时
+    tolerance: 当前OCR耗时中位数超过录制时的该倍数视为退化
+    返回报告字典
+    """
+    report = {
+        "records": 0,
+        "decisions_checked": 0,
+        "decision_divergences": [],
+        "ocr_checked": 0,
+        "price_divergences": [],
+    }
+    recorded_ocr_ms = []
+    replayed_ocr_ms = []
+    for record in records:
+        report["records"] += 1
+        price = record.get("price")
+        params = record.get("params") or {}
+        decision = record.get("decision")
+        if price is not None and decision is not None:
+            report["decisions_checked"] += 1
+            replayed = decide(
+                price,
+                params["ideal_price"],
+                params["unacceptable_price"],
+                params["key_mode"],
+            )
+            if replayed != decision:
+                report["decision_divergences"].append(
+                    {
+                        "iteration": record.get("iteration"),
+                        "price": price,
+                        "recorded": decision,
+                        "replayed": replayed,
+                    }
+                )
+
+        crop = record.get("crop")
+        if bot is None or crop is None or not isinstance(record.get("ocr"), list):
+            continue
+        report["ocr_checked"] += 1
+        start = time.perf_counter()
+        ocr_results = bot.reader.readtext(crop)
+        replayed_ocr_ms.append((time.perf_counter() - start) * 1000)
+        if "ocr" in record.get("timings", {}):
+            recorded_ocr_ms.append(record["timings"]["ocr"])
+        replayed_price, _ = bot.extract_price(ocr_results)
+        if replayed_price != price:
+            report["price_divergences"].append(
+                {
+                    "iteration": record.get("iteration"),
+                    "recorded": price,
+                    "replayed": replayed_price,
+                    "recorded_text": [text for text, _ in record["ocr"]],
+                    "replayed_text": [str(r[1]) for r in ocr_results],
+                }
+            )
+
+    if replayed_ocr_ms:
+        recorded = percentiles(recorded_ocr_ms)
+        current = percentiles(replayed_ocr_ms)
+        report["ocr_ms"] = {"recorded": recorded, "replayed": current}
+        report["ocr_regression"] = (
+            recorded["count"] > 0 and current["p50"] > recorded["p50"] * tolerance
+        )
+    return report
+
+
+def print_report(report):
+    print(
+        f"记录 {report['records']} 条，检查决策 {report['decisions_checked']} 次，"
+        f"不一致 {len(report['decision_divergences'])} 次"
+    )
+    for d in report["decision_divergences"][:20]:
+        print(
+            f"  第{d['iteration']}次循环 价格 {d['price']}: "
+            f"录制 {d['recorded']} -> 回放 {d['replayed']}"
+        )
+    if not report["ocr_checked"]:
+        return
+    print(
+        f"重新识别 {report['ocr_checked']} 张截图，"
+        f"价格不一致 {len(report['price_divergences'])} 次"
+    )
+    for d in report["price_divergences"][:20]:
+        print(
+            f"  第{d['iteration']}次循环: 录制 {d['recorded']} {d['recorded_text']} "
+            f"-> 回放 {d['replayed']} {d['replayed_text']}"
+        )
+    recorded = report["ocr_ms"]["recorded"]
+    current = report["ocr_ms"]["replayed"]
+    if recorded["count"]:
+        print(
+            f"OCR耗时中位数: 录制 {recorded['p50']:.1f}ms，"
+            f"回放 {current['p50']:.1f}ms"
+            + ("  <- 退化" if report["ocr_regression"] else "")
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的会话")
+    parser.add_argument("trace_dir", help="录制目录")
+    parser.add_argument(
+        "--ocr", action="store_true", help="用当前OCR引擎重新识别录制的截图"
+    )
+    parser.add_argument("--ocr-engine", default="easyocr")
+    parser.add_argument(
+        "--tolerance", type=float, default=1.5, help="OCR耗时退化的判定倍数"
+    )
+    parser.add_argument("--json", help="把完整报告写入该文件")
+    args = parser.parse_args()
+
+    bot = None
+    if args.ocr:
+        from backend.BuyBot import BuyBot
+
+        # 不使用OCR缓存，保证每张截图都真正识别一次
+        bot = BuyBot(ocr_engine=args.ocr_engine, ocr_cache_size=0)
+
+    report = replay(load_trace(args.trace_dir), bot=bot, tolerance=args.tolerance)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    diverged = report["decision_divergences"] or report["price_divergences"]
+    return 1 if diverged or report.get("ocr_regression") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
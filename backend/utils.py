@@ -1,20 +1,26 @@
 # -*- coding: utf-8 -*-
 
-import pyautogui
 import numpy as np
 import mss
 from PIL import Image
 import gc  # 添加垃圾回收模块
-import win32gui
-import win32ui
-import win32con
-import win32api
+import os
+import re
+import subprocess
+import sys
+import time
+
+# win32相关模块只在使用win32截图时才导入，减少启动耗时
+# pyautogui在用到鼠标或屏幕尺寸时才导入，没有显示器的Linux上导入就会失败，
+# 这样合成截图基准和回放等离线功能仍然可以运行
 
 
 def is_windowized(window_title: str):
     """
     判断目标是否窗口化
     """
+    import pyautogui
+
     # 获取当前所有窗口的标题
     window_titles = [window.title for window in pyautogui.getAllWindows()]
 
@@ -29,6 +35,8 @@ def get_window_postion(target_app: str):
     """
     获取目标窗口的坐标
     """
+    import pyautogui
+
     window_info = pyautogui.getWindowsWithTitle(target_app)[0]
     return [window_info.left, window_info.top, window_info.right, window_info.bottom]
 
@@ -37,6 +45,11 @@ def get_screenshot_win32():
     """
     使用win32api进行截图
     """
+    import win32gui
+    import win32ui
+    import win32con
+    import win32api
+
     # 获取屏幕分辨率
     width = win32api.GetSystemMetrics(win32con.SM_CXVIRTUALSCREEN)
     height = win32api.GetSystemMetrics(win32con.SM_CYVIRTUALSCREEN)
@@ -125,17 +138,164 @@ def get_screenshot_mss_debug_monitors():
         print("所有监视器截图（可能）成功。请检查生成的图片。")
     return problem_found
 
+class ReplayFrames:
+    """
+    回放录制好的全屏截图，代替真实屏幕，用于测试和无游戏环境下的多实例联调
+    按时间推进帧：当前帧 = 已运行秒数 * fps，循环播放
+    """
+
+    def __init__(self, frames_dir, fps=10.0):
+        names = sorted(
+            name
+            for name in os.listdir(frames_dir)
+            if name.lower().endswith((".png", ".jpg", ".bmp", ".npy"))
+        )
+        if not names:
+            raise ValueError(f"{frames_dir} 中没有截图文件")
+        self.frames = []
+        for name in names:
+            path = os.path.join(frames_dir, name)
+            if name.lower().endswith(".npy"):
+                frame = np.load(path)
+            else:
+                frame = np.asarray(Image.open(path).convert("RGB"))
+            self.frames.append(np.ascontiguousarray(frame[:, :, :3]))
+        self.fps = fps
+        self.start = time.perf_counter()
+        print(f"已加载 {len(self.frames)} 帧回放截图")
+
+    def current(self):
+        index = int((time.perf_counter() - self.start) * self.fps)
+        return self.frames[index % len(self.frames)]
+
+
+# 当前使用的回放源，由set_replay_frames设置
+_replay_frames = None
+
+
+def set_replay_frames(frames_dir, fps=10.0):
+    """设置"replay"截图方法使用的截图目录"""
+    global _replay_frames
+    _replay_frames = ReplayFrames(frames_dir, fps=fps)
+    return _replay_frames
+
+
+def get_screenshot_replay():
+    if _replay_frames is None:
+        raise RuntimeError("使用replay截图前需要先调用set_replay_frames")
+    return _replay_frames.current()
+
+
+def get_windowshot_replay(range: list):
+    """从回放帧中裁剪范围，比例坐标按帧尺寸换算"""
+    frame = get_screenshot_replay()
+    height, width = frame.shape[:2]
+    if range[0] < 1:
+        range = [
+            int(width * range[0]),
+            int(height * range[1]),
+            int(width * range[2]),
+            int(height * range[3]),
+        ]
+    return frame[range[1] : range[3], range[0] : range[2]].copy()
+
+
+def to_pixel_range(range: list, width=None, height=None):
+    """屏幕比例坐标转为像素坐标，默认按当前屏幕尺寸换算"""
+    if range[0] >= 1:
+        return list(range)
+    if width is None:
+        import pyautogui
+
+        screen_size = pyautogui.size()
+        width, height = screen_size.width, screen_size.height
+    return [
+        int(width * range[0]),
+        int(height * range[1]),
+        int(width * range[2]),
+        int(height * range[3]),
+    ]
+
+
+def get_windowshot_dxgi(range: list, first_frame_timeout=1.0):
+    """
+    使用DXGI Desktop Duplication（dxcam）进行范围截图，需要额外安装dxcam
+    dxcam在整个屏幕自上次截图后没有新帧时返回None，因此总是截取全屏并缓存，
+    没有新帧时从缓存的全屏中裁剪，任何区域得到的都是当前画面
+    get_windowshot_dxgi.fresh 表示最近一次是否拿到了新帧，供基准测试区分
+    """
+    if not hasattr(get_windowshot_dxgi, "camera"):
+        import dxcam
+
+        get_windowshot_dxgi.camera = dxcam.create(output_color="BGR")
+        get_windowshot_dxgi.frame = None
+        get_windowshot_dxgi.fresh = False
+
+    frame = get_windowshot_dxgi.camera.grab()
+    get_windowshot_dxgi.fresh = frame is not None
+    if frame is not None:
+        get_windowshot_dxgi.frame = frame
+    elif get_windowshot_dxgi.frame is None:
+        # 首次截图时等待第一帧
+        deadline = time.perf_counter() + first_frame_timeout
+        while frame is None and time.perf_counter() < deadline:
+            time.sleep(0.005)
+            frame = get_windowshot_dxgi.camera.grab()
+        if frame is None:
+            raise RuntimeError("dxgi截图超时，没有拿到第一帧")
+        get_windowshot_dxgi.frame = frame
+        get_windowshot_dxgi.fresh = True
+
+    height, width = get_windowshot_dxgi.frame.shape[:2]
+    left, top, right, bottom = to_pixel_range(range, width, height)
+    return get_windowshot_dxgi.frame[top:bottom, left:right].copy()
+
+
+# 合成截图使用的虚拟屏幕尺寸
+SYNTHETIC_SCREEN_SIZE = (2560, 1440)
+
+
+def get_windowshot_synthetic(range: list):
+    """
+    生成合成截图，不依赖真实屏幕，用于在Linux等环境下跑截图基准
+    内容为渐变加少量随时间变化的像素，尺寸与真实截图一致
+    """
+    left, top, right, bottom = to_pixel_range(range, *SYNTHETIC_SCREEN_SIZE)
+    width = right - left
+    height = bottom - top
+    if not hasattr(get_windowshot_synthetic, "base"):
+        get_windowshot_synthetic.base = {}
+    base = get_windowshot_synthetic.base.get((width, height))
+    if base is None:
+        gradient = np.linspace(40, 220, width, dtype=np.uint8)
+        base = np.repeat(np.tile(gradient, (height, 1))[:, :, None], 3, axis=2)
+        get_windowshot_synthetic.base[(width, height)] = base
+    img = base.copy()
+    img[0, int(time.perf_counter() * 1000) % width] = 255
+    return img
+
+
+# 支持的截图方法
+SCREENSHOT_METHODS = ["mss", "win32", "dxgi", "synthetic", "replay"]
+
+
 def get_screenshot(method="mss", debug_mode=False):
     """
     全屏截图函数，根据method参数选择截图方法
-    method: "mss" 或 "win32"
+    method: 见SCREENSHOT_METHODS
     """
     if method == "mss":
         result = get_screenshot_mss()
     elif method == "win32":
         result = get_screenshot_win32()
+    elif method == "dxgi":
+        result = get_windowshot_dxgi([0, 0, 1, 1])
+    elif method == "synthetic":
+        result = get_windowshot_synthetic([0, 0, 1, 1])
+    elif method == "replay":
+        result = get_screenshot_replay()
     else:
-        raise ValueError(f"不支持的截图方法: {method}，仅支持 'mss' 或 'win32'")
+        raise ValueError(f"不支持的截图方法: {method}，仅支持 {SCREENSHOT_METHODS}")
 
     if debug_mode:
         Image.fromarray(result).save(f"screenshot_{method}.png")
@@ -147,6 +307,11 @@ def get_windowshot_win32(range: list):
     """
     使用win32api进行范围截图
     """
+    import pyautogui
+    import win32gui
+    import win32ui
+    import win32con
+
     screen_size = pyautogui.size()
     if range[0] < 1:
         range = [
@@ -197,6 +362,8 @@ def get_windowshot_mss(range: list):
     if not hasattr(get_windowshot_mss, "sct"):
         get_windowshot_mss.sct = mss.mss()
 
+    import pyautogui
+
     screen_size = pyautogui.size()
     if range[0] < 1:
         range = [
@@ -227,23 +394,209 @@ def get_windowshot_mss(range: list):
 def get_windowshot(range: list, method="mss", debug_mode=False):
     """
     范围截图函数，根据method参数选择截图方法
-    method: "mss" 或 "win32"
+    method: 见SCREENSHOT_METHODS
     """
     if method == "mss":
         result = get_windowshot_mss(range)
     elif method == "win32":
         result = get_windowshot_win32(range)
+    elif method == "dxgi":
+        result = get_windowshot_dxgi(range)
+    elif method == "synthetic":
+        result = get_windowshot_synthetic(range)
+    elif method == "replay":
+        result = get_windowshot_replay(range)
     else:
-        raise ValueError(f"不支持的截图方法: {method}，仅支持 'mss' 或 'win32'")
+        raise ValueError(f"不支持的截图方法: {method}，仅支持 {SCREENSHOT_METHODS}")
 
     if debug_mode:
-        Image.fromarray(result).save(f"screenshot_{method}.png")
+        save_debug_screenshot(result, method)
 
     return result
 
 
+def save_debug_screenshot(img_np, method):
+    """保存调试截图到 screenshot_{method}.png"""
+    Image.fromarray(img_np).save(f"screenshot_{method}.png")
+
+
+def region_change_score(baseline, current):
+    """
+    两张同尺寸截图的平均像素差（0~255）
+    任意一张截图失败（None）时无法比较，视为没有变化；尺寸不一致时视为完全变化
+    """
+    if baseline is None or current is None:
+        return 0.0
+    if baseline.shape != current.shape:
+        return 255.0
+    return float(np.mean(np.abs(current.astype(np.int16) - baseline.astype(np.int16))))
+
+
+def wait_region_change(
+    range: list, baseline, timeout=0.3, threshold=8.0, interval=0.01, method="mss"
+):
+    """
+    在timeout秒内反复截取range区域，直到与baseline的差异超过threshold
+    返回 (是否发生变化, 等待耗时秒)
+    """
+    return wait_regions_change(
+        [range], [baseline], timeout, threshold=threshold, interval=interval, method=method
+    )
+
+
+def wait_regions_change(
+    ranges: list, baselines: list, timeout=0.3, threshold=8.0, interval=0.01, method="mss"
+):
+    """
+    同wait_region_change，任意一个区域发生变化即返回
+    """
+    start = time.perf_counter()
+    deadline = start + timeout
+    while True:
+        for range, baseline in zip(ranges, baselines):
+            current = get_windowshot(range, method=method)
+            if region_change_score(baseline, current) >= threshold:
+                return True, time.perf_counter() - start
+        if time.perf_counter() >= deadline:
+            return False, time.perf_counter() - start
+        time.sleep(interval)
+
+
+class RegionWatcher:
+    """
+    低开销的区域变化检测，用于高频（100Hz以上）盯住价格行
+    每次只取截图中按step跨步抽样的一个通道，写入预先分配好的小缓冲区，
+    与基准帧比较得到变化分数；只有发生变化时才需要调用完整的detect_price
+    对所有截图方法通用
+    """
+
+    def __init__(self, range: list, method="mss", step=4, threshold=8.0):
+        self.range = range
+        self.method = method
+        self.step = step
+        self.threshold = threshold
+        self._baseline = None
+        self._current = None
+        self._diff = None
+        # 最近一次score()是否真正完成了比较（截图成功且已有基准帧）
+        self.sample_ok = False
+
+    def _sample_into(self, out):
+        """截图并把抽样结果写入out，首次调用时按截图尺寸分配缓冲区"""
+        img = get_windowshot(self.range, method=self.method)
+        if img is None:
+            return None
+        sparse = img[:: self.step, :: self.step, 1]
+        if out is None or out.shape != sparse.shape:
+            out = np.empty(sparse.shape, dtype=np.int16)
+            self._diff = np.empty(sparse.shape, dtype=np.int16)
+        np.copyto(out, sparse, casting="unsafe")
+        return out
+
+    def reset(self):
+        """以当前画面作为基准帧"""
+        self._baseline = self._sample_into(self._baseline)
+
+    def score(self):
+        """
+        当前画面与基准帧的平均差异（0~255），没有基准帧时先建立基准
+        截图失败时无法比较，视为没有变化
+        """
+        self.sample_ok = False
+        if self._baseline is None:
+            self.reset()
+            return 0.0
+        current = self._sample_into(self._current)
+        if current is None:
+            return 0.0
+        self._current = current
+        self.sample_ok = True
+        if self._current.shape != self._baseline.shape:
+            return 255.0
+        np.subtract(self._current, self._baseline, out=self._diff)
+        np.abs(self._diff, out=self._diff)
+        return float(self._diff.mean())
+
+    def changed(self):
+        return self.score() >= self.threshold
+
+    def wait_stable(self, timeout=1.0, samples=3, interval=0.005):
+        """
+        等待画面稳定：连续samples次采样与前一次采样几乎相同
+        用于判断页面切换后内容已经加载完成，返回 (是否稳定, 等待耗时秒)
+        """
+        start = time.perf_counter()
+        deadline = start + timeout
+        self.reset()
+        stable = 0
+        while True:
+            score = self.score()
+            # 截图失败的采样既不算稳定也不作为下一次的基准
+            if self.sample_ok:
+                if score < self.threshold:
+                    stable += 1
+                    if stable >= samples:
+                        return True, time.perf_counter() - start
+                else:
+                    stable = 0
+                # 当前采样作为下一次比较的基准，交换缓冲区，不用重新截图
+                self._baseline, self._current = self._current, self._baseline
+            now = time.perf_counter()
+            if now >= deadline:
+                return False, now - start
+            time.sleep(interval)
+
+    def wait_change(self, timeout=1.0, interval=0.005):
+        """
+        以约1/interval的频率采样，直到画面变化或超时
+        返回 (是否发生变化, 等待耗时秒)
+        """
+        start = time.perf_counter()
+        deadline = start + timeout
+        while True:
+            if self.changed():
+                return True, time.perf_counter() - start
+            now = time.perf_counter()
+            if now >= deadline:
+                return False, now - start
+            time.sleep(interval)
+
+    def measure_cost(self, rate_hz=100, seconds=2.0):
+        """
+        以rate_hz的频率采样seconds秒，统计开销
+        返回 {"rate_hz": 目标频率, "achieved_hz": 实际频率,
+              "sample_ms": 单次采样平均耗时, "cpu_percent": 占用单核的百分比}
+        """
+        interval = 1.0 / rate_hz
+        self.reset()
+        samples = 0
+        busy = 0.0
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        next_tick = start
+        while time.perf_counter() - start < seconds:
+            tick_start = time.perf_counter()
+            self.score()
+            busy += time.perf_counter() - tick_start
+            samples += 1
+            next_tick += interval
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        return {
+            "rate_hz": rate_hz,
+            "achieved_hz": samples / wall,
+            "sample_ms": busy / max(samples, 1) * 1000,
+            "cpu_percent": cpu / wall * 100,
+        }
+
+
 def mouse_click(position: list, num: int = 1):
     """优化的鼠标点击函数"""
+    import pyautogui
+
     x = position[0]
     y = position[1]
     if x < 1:
@@ -259,13 +612,83 @@ def mouse_click(position: list, num: int = 1):
         pyautogui.click()
 
 
+def mouse_move(position: list):
+    """把鼠标移动到指定位置但不点击"""
+    import pyautogui
+
+    x = position[0]
+    y = position[1]
+    if x < 1:
+        screen_size = pyautogui.size()
+        x = int(screen_size.width * x)
+        y = int(screen_size.height * y)
+    pyautogui.moveTo(x, y)
+
+
 def get_mouse_position():
     """
     获取鼠标当前位置
     """
+    import pyautogui
+
     return list(pyautogui.position())
 
 
+def profile_imports(modules=None, top=10):
+    """
+    统计各模块的冷启动导入耗时
+    每个模块在独立的子进程中用 -X importtime 导入，互不影响缓存
+    返回 [(模块名, 总耗时秒, [(子模块, 耗时秒), ...]), ...]，按耗时降序
+    """
+    if modules is None:
+        modules = [
+            "PyQt5.QtWidgets",
+            "keyboard",
+            "pyautogui",
+            "mss",
+            "PIL.Image",
+            "numpy",
+            "win32gui",
+            "torch",
+            "easyocr",
+        ]
+
+    line_pattern = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+    report = []
+    for module in modules:
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            print(f"{module}: 导入失败")
+            continue
+
+        # 每行格式: import time: self [us] | cumulative | imported package
+        children = []
+        total = 0.0
+        for line in proc.stderr.splitlines():
+            match = line_pattern.match(line)
+            if match is None:
+                continue
+            cumulative = int(match.group(2)) / 1e6
+            name = match.group(4)
+            if name == module:
+                total = cumulative
+            children.append((name, cumulative))
+        children.sort(key=lambda item: item[1], reverse=True)
+        report.append((module, total, children[1 : top + 1]))
+
+    report.sort(key=lambda item: item[1], reverse=True)
+    print("模块导入耗时报告（冷启动）:")
+    for module, total, children in report:
+        print(f"{module:<20} {total * 1000:>9.1f} ms")
+        for name, cumulative in children:
+            print(f"    {name:<40} {cumulative * 1000:>9.1f} ms")
+    return report
+
+
 def main():
     # 测试两种截图方法
     print("测试MSS截图...")